@@ -0,0 +1,184 @@
+"""Benchmark the poll -> match -> notify pipeline against synthetic users and a fake Bot API.
+
+    python gag_bench.py --users 1000 10000 100000 --out bench.json
+    python gag_bench.py --users 100000 --shards 4   # match and send in 4 worker processes
+
+Each size runs in its own subprocess so peak RSS is measured per size.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+import gag_db
+from gag_catalog import Catalog
+from gag_diff import diff_stock
+from gag_dispatch import Dispatcher
+from gag_fakes import FakeTelegramServer, StockStubServer
+from gag_http import HttpClient
+from gag_index import SubscriptionIndex
+from gag_shard import ShardPool
+from gag_stock import build_message, parse_stock
+
+HERE = Path(__file__).resolve().parent
+FIRST_USER_ID = 1_000_000_000
+
+
+def catalog_names(payload):
+    names = {item["name"] for item in payload.get("lastSeen", [])}
+    names.update(json.loads((HERE / "gag_watchlist.json").read_text()))
+    return sorted(names)
+
+
+def populate(db, n_users, watch, names, seed):
+    rng = random.Random(seed)
+    conn = db.conn
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO items (name) VALUES (?)', [(name,) for name in names])
+    item_ids = [row[0] for row in conn.execute('SELECT id FROM items')]
+    watch = min(watch, len(item_ids))
+    chunk = 50_000
+    for start in range(0, n_users, chunk):
+        user_ids = list(range(FIRST_USER_ID + start, FIRST_USER_ID + min(start + chunk, n_users)))
+        with conn:
+            conn.executemany('INSERT INTO users (id, username, is_notified) VALUES (?, ?, 1)',
+                             [(user_id, f"user{user_id}") for user_id in user_ids])
+            conn.executemany('INSERT OR IGNORE INTO watchlist (user_id, item_id) VALUES (?, ?)',
+                             ((user_id, item_id) for user_id in user_ids
+                              for item_id in rng.sample(item_ids, watch)))
+
+
+@contextmanager
+def timed(timings, stage):
+    started = time.perf_counter()
+    yield
+    timings[stage] = round(time.perf_counter() - started, 6)
+
+
+async def run_single(args):
+    payload = json.loads(Path(args.payload).read_text())
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        db = gag_db.Database(db_path).open()
+        with timed(timings, "generate"):
+            populate(db, args.single, args.watch, catalog_names(payload), args.seed)
+
+        subscriptions = SubscriptionIndex()
+        catalog = Catalog()
+        with timed(timings, "index_load"):
+            subscriptions.load(db.conn)
+            catalog.load(db.conn)
+
+        stock_server = await StockStubServer([payload]).start()
+        telegram_server = await FakeTelegramServer().start()
+        http = await HttpClient().start()
+        bot = Bot("123456:bench", base_url=telegram_server.base_url,
+                  request=HTTPXRequest(connection_pool_size=args.workers))
+        await bot.initialize()
+        dispatcher = Dispatcher(bot, workers=args.workers, rate=1e9, chat_interval=0)
+        pool = None
+        if args.shards:
+            with timed(timings, "shard_start"):
+                pool = await ShardPool(args.shards, db_path, {"token": "123456:bench", "base_url": telegram_server.base_url},
+                                       rate=1e9, workers=args.workers, chat_interval=0).start()
+        try:
+            with timed(timings, "fetch"):
+                data = await http.get_json(stock_server.url)
+            with timed(timings, "parse"):
+                current = parse_stock(data)
+                changes = diff_stock({}, current)
+            check_at = datetime.now().strftime("%H:%M:%S")
+            changed = {catalog.ids[name]: name for name in changes if name in catalog.ids}
+            if pool is not None:
+                # Matching, building and sending all happen inside the shard workers
+                with timed(timings, "send"):
+                    stats = await pool.broadcast(check_at, changes, changed, limit=args.max_messages or None)
+                matched = stats["matched"]
+            else:
+                with timed(timings, "match"):
+                    matches = subscriptions.match(changed)
+                with timed(timings, "build"):
+                    messages = [(user_id, {"text": build_message(check_at, item_names, changes), "parse_mode": 'Markdown'})
+                                for user_id, item_names in matches.items()]
+                to_send = messages[:args.max_messages] if args.max_messages else messages
+                with timed(timings, "send"):
+                    stats = await dispatcher.broadcast(to_send)
+                matched = len(matches)
+        finally:
+            if pool is not None:
+                await pool.stop()
+            await dispatcher.stop()
+            await bot.shutdown()
+            await http.close()
+            await telegram_server.stop()
+            await stock_server.stop()
+            db.close()
+
+    return {
+        "users": args.single,
+        "watch": args.watch,
+        "shards": args.shards,
+        "matched_users": matched,
+        "messages_sent": stats["sent"],
+        "messages_failed": stats["failed"],
+        "msgs_per_sec": round(stats["rate"], 1),
+        "stages": timings,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--watch", type=int, default=20, help="watchlist size per user")
+    parser.add_argument("--payload", default=str(HERE / "example_stock.json"))
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--max-messages", type=int, default=20_000,
+                        help="cap on messages actually sent per run (0 = all)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--shards", type=int, default=0, help="worker processes for matching and sending (0 = in-process)")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(asyncio.run(run_single(args))))
+        return
+
+    runs = []
+    for n_users in args.users:
+        print(f"⏱️ Benchmarking {n_users} users")
+        cmd = [sys.executable, __file__, "--single", str(n_users), "--watch", str(args.watch),
+               "--payload", args.payload, "--workers", str(args.workers),
+               "--max-messages", str(args.max_messages), "--seed", str(args.seed), "--shards", str(args.shards)]
+        output = subprocess.run(cmd, check=True, capture_output=True, text=True, cwd=HERE).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"   {result['stages']} {result['msgs_per_sec']} msg/s, peak {result['peak_rss_mb']} MB")
+        runs.append(result)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "runs": runs,
+    }
+    Path(args.out).write_text(json.dumps(report, indent=2))
+    print(f"✅ Wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
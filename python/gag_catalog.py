@@ -0,0 +1,54 @@
+import time
+
+
+class Catalog:
+    """In-memory mirror of the items table, refreshed from the upstream lastSeen list."""
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.ids = {}
+        self.names = []
+        self.refreshed_at = 0.0
+        self.version = 0
+
+    def load(self, conn):
+        self.ids = {name: item_id for item_id, name in conn.execute('SELECT id, name FROM items WHERE listed = 1')}
+        self._reindex()
+
+    def is_stale(self):
+        return time.monotonic() - self.refreshed_at > self.ttl
+
+    def changes(self, last_seen):
+        # (added, removed) names lastSeen would change; read on the event loop, which owns the in-memory catalog
+        self.refreshed_at = time.monotonic()
+        seen = {item["name"] for item in last_seen if item.get("seen") is not None}
+        unseen = {item["name"] for item in last_seen if item.get("seen") is None}
+        return [name for name in seen if name not in self.ids], [name for name in unseen if name in self.ids]
+
+    @staticmethod
+    def write(conn, added, removed):
+        # Runs on the DB thread; returns {name: item_id} for the added names. Items that drop out are
+        # unlisted, not deleted: watchlists and the stock history keep referring to their ids
+        conn.executemany('INSERT INTO items (name) VALUES (?) ON CONFLICT(name) DO UPDATE SET listed = 1',
+                         [(name,) for name in added])
+        conn.executemany('UPDATE items SET listed = 0 WHERE name = ?', [(name,) for name in removed])
+        if not added:
+            return {}
+        rows = conn.execute('SELECT id, name FROM items WHERE name IN ({})'.format(','.join('?' * len(added))), added)
+        return {name: item_id for item_id, name in rows}
+
+    def apply(self, added_ids, removed):
+        # Back on the event loop: applies what write() stored
+        for name in removed:
+            self.ids.pop(name, None)
+        self.ids.update(added_ids)
+        self._reindex()
+
+    def add(self, name, item_id):
+        if self.ids.get(name) != item_id:
+            self.ids[name] = item_id
+            self._reindex()
+
+    def _reindex(self):
+        self.names = sorted(self.ids)
+        self.version += 1
@@ -0,0 +1,66 @@
+"""The stock pipeline shared by gag_notifier.py and gag_notifier_v2.py: poll, parse, diff, match, schedule.
+
+Importing this module does no I/O and pulls in neither python-telegram-bot nor aiohttp; the HTTP client
+is passed in and storage stays with the caller, so the notifiers, the bench and one-off scripts can all
+drive the same loop in-process.
+"""
+import asyncio
+import time
+from datetime import datetime
+
+from gag_diff import diff_stock
+from gag_scheduler import RestockScheduler
+from gag_stock import StockFetcher, flatten_stock, parse_categories
+
+STOCK_URL = "https://growagarden.gg/api/stock"
+
+
+def check_time(clock=time.time):
+    return datetime.fromtimestamp(clock()).strftime("%H:%M:%S")
+
+
+def changed_items(changes, item_ids):
+    # Resolves changed names to item ids once, in the {item_id: name} shape SubscriptionIndex.match takes
+    return {item_ids[name]: name for name in changes if name in item_ids}
+
+
+class StockEngine:
+    """Polls the stock API on the restock schedule and diffs each new snapshot against the previous one."""
+
+    def __init__(self, http, url=STOCK_URL, scheduler=None, clock=time.time, sleep=asyncio.sleep):
+        # clock and sleep are injectable so gag_replay.py can run the loop on a virtual clock
+        self.fetcher = StockFetcher(http, url)
+        self.scheduler = scheduler if scheduler is not None else RestockScheduler(clock=clock)
+        self.clock = clock
+        self.sleep = sleep
+        self.previous = {}
+
+    async def poll(self):
+        # Returns (data, categories); categories is None when the payload has not changed
+        try:
+            data, changed = await self.fetcher.fetch()
+        except Exception:
+            self.fetcher.reset()
+            raise
+        return data, parse_categories(data) if changed else None
+
+    def advance(self, categories):
+        # Makes the snapshot the new baseline; returns ({name: quantity}, changes since the previous one)
+        current = flatten_stock(categories)
+        changes = diff_stock(self.previous, current)
+        self.previous = current
+        return current, changes
+
+    async def run(self, check, paused=None, pause_interval=5):
+        # check(check_at) polls once and returns the payload it saw, or None when the poll failed
+        while True:
+            if paused is not None and paused():
+                await self.sleep(pause_interval)
+                continue
+            check_at = check_time(self.clock)
+            print(f"⏰ Check at {check_at}")
+            data = await check(check_at)
+            self.scheduler.observe(data, self.fetcher.fingerprint)
+            wait = self.scheduler.next_delay()
+            print(f"🕒 Sleep for {int(wait)} s")
+            await self.sleep(wait)
@@ -0,0 +1,365 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from gag_history import create_partition, partitions
+from gag_metrics import DB_QUERIES, DB_SECONDS, current_handler
+
+DB_PATH = 'gag_notifier.db'
+CHUNK_SIZE = 500  # Bound parameters per IN (...) query, well under SQLite's limit
+
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA busy_timeout = 5000',
+)
+
+
+def _migrate_base(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+    conn.execute('CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, username TEXT, is_notified INTEGER DEFAULT 1)')
+    conn.execute('CREATE TABLE IF NOT EXISTS watchlist (user_id TEXT, item_id INTEGER, FOREIGN KEY(user_id) REFERENCES users(id), FOREIGN KEY(item_id) REFERENCES items(id))')
+    if 'is_blocked' not in [row[1] for row in conn.execute('PRAGMA table_info(users)')]:
+        conn.execute('ALTER TABLE users ADD COLUMN is_blocked INTEGER DEFAULT 0')
+
+
+def _migrate_watchlist_key(conn):
+    # Deduplicate the watchlist into a (user_id, item_id) keyed table and index item lookups
+    conn.execute('''
+        CREATE TABLE watchlist_new (
+            user_id TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, item_id),
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            FOREIGN KEY(item_id) REFERENCES items(id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('INSERT OR IGNORE INTO watchlist_new (user_id, item_id) '
+                 'SELECT CAST(user_id AS TEXT), item_id FROM watchlist WHERE user_id IS NOT NULL AND item_id IS NOT NULL')
+    conn.execute('DROP TABLE watchlist')
+    conn.execute('ALTER TABLE watchlist_new RENAME TO watchlist')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_watchlist_item ON watchlist (item_id)')
+
+
+def _migrate_history(conn):
+    # Lookup tables for the stock history; the per-month row tables are created by gag_history
+    conn.execute('CREATE TABLE history_items (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)')
+    conn.execute('CREATE TABLE history_categories (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)')
+    conn.execute('CREATE TABLE history_snapshots (taken_at INTEGER PRIMARY KEY, items INTEGER NOT NULL)')
+
+
+def _migrate_delivery(conn):
+    # Per-user delivery: 'message' sends each update, 'live' edits one pinned message; optional digest window
+    conn.execute("ALTER TABLE users ADD COLUMN delivery TEXT NOT NULL DEFAULT 'message'")
+    conn.execute('ALTER TABLE users ADD COLUMN live_message_id INTEGER')
+    conn.execute('ALTER TABLE users ADD COLUMN digest_minutes INTEGER NOT NULL DEFAULT 0')
+
+
+def _migrate_rules(conn):
+    # Stock rules: an item, a category or both, with a minimum quantity; NULL means any
+    conn.execute('''
+        CREATE TABLE rules (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            category TEXT,
+            item_id INTEGER,
+            min_quantity INTEGER NOT NULL DEFAULT 1,
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            FOREIGN KEY(item_id) REFERENCES items(id)
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_rules_user ON rules (user_id)')
+
+
+def _migrate_outbox(conn):
+    # Matched notifications not yet delivered; rows are deleted once the dispatcher is done with them
+    conn.execute('''
+        CREATE TABLE outbox (
+            id INTEGER PRIMARY KEY,
+            created_at REAL NOT NULL,
+            chat_id TEXT NOT NULL,
+            payload TEXT NOT NULL
+        )
+    ''')
+
+
+def _migrate_integer_ids(conn):
+    # User and chat ids become INTEGER keys, and item names are interned once, in items, for the catalog
+    # and the stock history alike; items dropped from the catalog are flagged unlisted instead of deleted
+    conn.execute('ALTER TABLE items ADD COLUMN listed INTEGER NOT NULL DEFAULT 1')
+    conn.execute('INSERT OR IGNORE INTO items (name, listed) SELECT name, 0 FROM history_items')
+    conn.execute('CREATE TEMP TABLE history_item_ids AS '
+                 'SELECT history_items.id AS old_id, items.id AS new_id FROM history_items JOIN items USING (name)')
+    for table in partitions(conn):
+        create_partition(conn, f'{table}_new')
+        conn.execute(f'INSERT OR REPLACE INTO {table}_new SELECT new_id, taken_at, category_id, quantity, appeared '
+                     f'FROM {table} JOIN history_item_ids ON old_id = item_id')
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    conn.execute('DROP TABLE history_item_ids')
+    conn.execute('DROP TABLE history_items')
+
+    # Rows whose id is not a plain integer could never have been a Telegram chat; they are dropped
+    conn.execute('''
+        CREATE TABLE users_new (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            is_notified INTEGER NOT NULL DEFAULT 1,
+            is_blocked INTEGER NOT NULL DEFAULT 0,
+            delivery TEXT NOT NULL DEFAULT 'message',
+            live_message_id INTEGER,
+            digest_minutes INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO users_new SELECT CAST(id AS INTEGER), username, COALESCE(is_notified, 1), '
+                 'COALESCE(is_blocked, 0), delivery, live_message_id, digest_minutes FROM users '
+                 'WHERE CAST(CAST(id AS INTEGER) AS TEXT) = id')
+    conn.execute('''
+        CREATE TABLE watchlist_new (
+            user_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, item_id),
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            FOREIGN KEY(item_id) REFERENCES items(id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('INSERT OR IGNORE INTO watchlist_new SELECT CAST(user_id AS INTEGER), item_id FROM watchlist '
+                 'WHERE CAST(CAST(user_id AS INTEGER) AS TEXT) = user_id')
+    conn.execute('''
+        CREATE TABLE rules_new (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            category TEXT,
+            item_id INTEGER,
+            min_quantity INTEGER NOT NULL DEFAULT 1,
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            FOREIGN KEY(item_id) REFERENCES items(id)
+        )
+    ''')
+    conn.execute('INSERT INTO rules_new SELECT id, CAST(user_id AS INTEGER), category, item_id, min_quantity FROM rules '
+                 'WHERE CAST(CAST(user_id AS INTEGER) AS TEXT) = user_id')
+    conn.execute('CREATE TABLE outbox_new (id INTEGER PRIMARY KEY, created_at REAL NOT NULL, chat_id INTEGER NOT NULL, '
+                 'payload TEXT NOT NULL)')
+    conn.execute('INSERT INTO outbox_new SELECT id, created_at, CAST(chat_id AS INTEGER), payload FROM outbox')
+    for table in ('users', 'watchlist', 'rules', 'outbox'):
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    conn.execute('CREATE INDEX idx_watchlist_item ON watchlist (item_id)')
+    conn.execute('CREATE INDEX idx_rules_user ON rules (user_id)')
+
+
+def _migrate_orphan_users(conn):
+    # Users whose watchlist or rules were written but whose own row was lost with a crash before the
+    # user cache flushed it; without a row the index skips them. See _ensure_user
+    conn.execute('INSERT OR IGNORE INTO users (id) SELECT user_id FROM watchlist UNION SELECT user_id FROM rules')
+
+
+# Applied in order; PRAGMA user_version records how many have run
+MIGRATIONS = [
+    _migrate_base,
+    _migrate_watchlist_key,
+    _migrate_history,
+    _migrate_delivery,
+    _migrate_rules,
+    _migrate_outbox,
+    _migrate_integer_ids,
+    _migrate_orphan_users,
+]
+
+
+class Database:
+    """One long-lived SQLite connection; blocking work runs on a single dedicated thread."""
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self.conn = None
+        self.executor = None
+
+    def open(self):
+        # Statements are cached per connection by their SQL text, so keep queries as constant strings
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        for pragma in PRAGMAS:
+            self.conn.execute(pragma)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self.migrate()
+        return self
+
+    def migrate(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            with self.conn:
+                self.conn.execute('BEGIN')  # DDL is not wrapped implicitly; keep each migration atomic
+                migration(self.conn)
+                self.conn.execute(f'PRAGMA user_version = {number}')
+            print(f"🗄️ Applied migration {number}: {migration.__name__}")
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _call(self, fn, args):
+        try:
+            result = fn(self.conn, *args)
+            self.conn.commit()
+            return result
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+    async def run(self, fn, *args):
+        # fn(conn, *args) runs as one transaction on the DB thread
+        loop = asyncio.get_running_loop()
+        handler = current_handler.get()
+        DB_QUERIES.inc(handler=handler, query=fn.__name__)
+        with DB_SECONDS.time(handler=handler):
+            return await loop.run_in_executor(self.executor, self._call, fn, args)
+
+
+# Queries; each takes the connection as its first argument so it can be passed to Database.run
+
+def upsert_users(conn, rows):
+    # rows: (id, username, is_notified, is_blocked, delivery, live_message_id, digest_minutes), full current state
+    # except username: None keeps the stored one and '' clears it
+    conn.executemany('INSERT INTO users (id, username, is_notified, is_blocked, delivery, live_message_id, digest_minutes) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                     'ON CONFLICT(id) DO UPDATE SET username = COALESCE(excluded.username, users.username), '
+                     'is_notified = excluded.is_notified, is_blocked = excluded.is_blocked, '
+                     'delivery = excluded.delivery, live_message_id = excluded.live_message_id, '
+                     'digest_minutes = excluded.digest_minutes', rows)
+    return len(rows)
+
+
+def _ensure_user(conn, user_id):
+    # User rows are written by the user cache's periodic flush, watchlist rows and rules right away; create the
+    # row with the defaults in the same transaction so a crash before the flush cannot leave them orphaned
+    conn.execute('INSERT OR IGNORE INTO users (id) VALUES (?)', (int(user_id),))
+
+
+def add_watch(conn, user_id, item_id):
+    # True when the row was inserted, False when it was already there
+    _ensure_user(conn, user_id)
+    return conn.execute('INSERT OR IGNORE INTO watchlist (user_id, item_id) VALUES (?, ?)',
+                        (int(user_id), item_id)).rowcount > 0
+
+
+def remove_watch(conn, user_id, item_id):
+    return conn.execute('DELETE FROM watchlist WHERE user_id = ? AND item_id = ?',
+                        (int(user_id), item_id)).rowcount > 0
+
+
+def watchlist_names(conn, user_id):
+    rows = conn.execute('SELECT items.name FROM watchlist JOIN items ON watchlist.item_id = items.id '
+                        'WHERE watchlist.user_id = ?', (int(user_id),))
+    return [row[0] for row in rows]
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def resolve_items(conn, names):
+    # {name: item_id} for every name, creating missing items; one SELECT per chunk of names
+    ids = {}
+    names = list(dict.fromkeys(names))
+    for chunk in _chunks(names):
+        ids.update(conn.execute(f'SELECT name, id FROM items WHERE name IN ({",".join("?" * len(chunk))})', chunk))
+    missing = [name for name in names if name not in ids]
+    if missing:
+        conn.executemany('INSERT OR IGNORE INTO items (name) VALUES (?)', [(name,) for name in missing])
+        for chunk in _chunks(missing):
+            ids.update(conn.execute(f'SELECT name, id FROM items WHERE name IN ({",".join("?" * len(chunk))})', chunk))
+    return ids
+
+
+def watched_ids(conn, user_id, item_ids=None):
+    # The user's watched item ids, optionally restricted to item_ids
+    if item_ids is None:
+        return {row[0] for row in conn.execute('SELECT item_id FROM watchlist WHERE user_id = ?', (int(user_id),))}
+    watched = set()
+    for chunk in _chunks(item_ids):
+        watched.update(row[0] for row in conn.execute(
+            f'SELECT item_id FROM watchlist WHERE user_id = ? AND item_id IN ({",".join("?" * len(chunk))})',
+            [int(user_id), *chunk]))
+    return watched
+
+
+def watchers(conn, items):
+    # items: {item_id: item_name}; returns {user_id: [item_name, ...]} for everyone watching one of them
+    matches = {}
+    for chunk in _chunks(list(items)):
+        for user_id, item_id in conn.execute(
+                f'SELECT user_id, item_id FROM watchlist WHERE item_id IN ({",".join("?" * len(chunk))})', chunk):
+            matches.setdefault(user_id, []).append(items[item_id])
+    return matches
+
+
+def add_watch_names(conn, user_id, names):
+    # Returns ([(name, item_id) added], [already watched], [failed])
+    ids = resolve_items(conn, names)
+    watched = watched_ids(conn, user_id, set(ids.values()))
+    added, already, failed = [], [], []
+    for name in dict.fromkeys(names):
+        item_id = ids.get(name)
+        if item_id is None:
+            failed.append(name)
+        elif item_id in watched:
+            already.append(name)
+        else:
+            added.append((name, item_id))
+            watched.add(item_id)
+    if added:
+        _ensure_user(conn, user_id)
+    conn.executemany('INSERT OR IGNORE INTO watchlist (user_id, item_id) VALUES (?, ?)',
+                     [(int(user_id), item_id) for _, item_id in added])
+    return added, already, failed
+
+
+def remove_watch_ids(conn, user_id, item_ids):
+    # Returns the subset of item_ids that were actually in the watchlist
+    watched = watched_ids(conn, user_id, item_ids)
+    removed = [item_id for item_id in dict.fromkeys(item_ids) if item_id in watched]
+    conn.executemany('DELETE FROM watchlist WHERE user_id = ? AND item_id = ?',
+                     [(int(user_id), item_id) for item_id in removed])
+    return removed
+
+
+def replace_watchlist(conn, user_id, names):
+    # Makes the watchlist exactly `names`; returns ([(name, item_id) added], [removed item_ids])
+    ids = resolve_items(conn, names)
+    wanted = set(ids.values())
+    watched = watched_ids(conn, user_id)
+    removed = sorted(watched - wanted)
+    added = [(name, item_id) for name, item_id in ids.items() if item_id not in watched]
+    if added:
+        _ensure_user(conn, user_id)
+    conn.executemany('DELETE FROM watchlist WHERE user_id = ? AND item_id = ?',
+                     [(int(user_id), item_id) for item_id in removed])
+    conn.executemany('INSERT OR IGNORE INTO watchlist (user_id, item_id) VALUES (?, ?)',
+                     [(int(user_id), item_id) for _, item_id in added])
+    return added, removed
+
+
+def add_rule(conn, user_id, category, item_id, min_quantity):
+    # Returns the new rule id
+    _ensure_user(conn, user_id)
+    return conn.execute('INSERT INTO rules (user_id, category, item_id, min_quantity) VALUES (?, ?, ?, ?)',
+                        (int(user_id), category, item_id, min_quantity)).lastrowid
+
+
+def remove_rule(conn, user_id, rule_id):
+    return conn.execute('DELETE FROM rules WHERE id = ? AND user_id = ?', (rule_id, int(user_id))).rowcount > 0
+
+
+def user_rules(conn, user_id):
+    # [(rule_id, category, item name or None, min_quantity)] in the order they were added
+    return conn.execute('SELECT rules.id, rules.category, items.name, rules.min_quantity FROM rules '
+                        'LEFT JOIN items ON rules.item_id = items.id WHERE rules.user_id = ? ORDER BY rules.id',
+                        (int(user_id),)).fetchall()
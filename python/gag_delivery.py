@@ -0,0 +1,78 @@
+import time
+from datetime import datetime
+
+from gag_diff import merge_changes
+from gag_keyboards import MAIN_KEYBOARDS
+from gag_stock import build_message
+
+MESSAGE = 'message'
+LIVE = 'live'
+DELIVERY_MODES = (MESSAGE, LIVE)
+MAX_DIGEST_MINUTES = 60
+
+
+class Delivery:
+    """Turns each user's matched changes into dispatcher messages according to their settings.
+
+    'message' sends a new message per update, listing the changes; 'live' edits the user's pinned live
+    message in place (sent and pinned the first time, see on_sent) so it shows the watched items in
+    stock now, read from the board, plus whatever else triggered the update. With a digest window,
+    changes are held back and merged until the window closes, then delivered as one update.
+    """
+
+    def __init__(self, users, board, catalog, subscriptions, clock=time.time):
+        self.users = users
+        self.board = board
+        self.catalog = catalog
+        self.subscriptions = subscriptions
+        self.clock = clock
+        self.pending = {}  # user_id -> [window start, first check_at, merged changes]
+        self.in_stock = (None, [])  # (board.categories, their item ids), shared by one broadcast's users
+
+    def plan(self, user_id, check_at, item_names, changes):
+        # Returns a (chat_id, kwargs) to send now, or None when the changes went into a digest
+        user_changes = {name: changes[name] for name in item_names}
+        if self.users.digest_minutes(user_id):
+            entry = self.pending.get(user_id)
+            if entry is None:
+                self.pending[user_id] = [self.clock(), check_at, user_changes]
+            else:
+                entry[2] = merge_changes(entry[2], user_changes)
+            return None
+        return self.message(user_id, check_at, user_changes)
+
+    def due(self):
+        # Digests whose window has closed; items that ended where they started are dropped
+        now = self.clock()
+        ready = []
+        for user_id, (started, first_check_at, user_changes) in list(self.pending.items()):
+            if now - started >= self.users.digest_minutes(user_id) * 60:
+                del self.pending[user_id]
+                if user_changes:
+                    header = f"📦 Stock digest since {first_check_at}:"
+                    ready.append(self.message(user_id, first_check_at, user_changes, header))
+        return ready
+
+    def message(self, user_id, check_at, user_changes, header=None):
+        kwargs = {"parse_mode": 'Markdown', "reply_markup": MAIN_KEYBOARDS[True]}
+        if self.users.delivery_mode(user_id) == LIVE:
+            message_id = self.users.live_message(user_id)
+            if message_id is not None:
+                kwargs.update(method="edit_message_text", message_id=message_id)
+            kwargs["tag"] = LIVE  # Record the message id if this ends up sending a new message
+            kwargs["text"] = self.live_text(user_id, user_changes)
+        else:
+            kwargs["text"] = build_message(check_at, list(user_changes), user_changes, header)
+        return user_id, kwargs
+
+    def live_text(self, user_id, user_changes):
+        # The current state rather than the changes: watched items on the board, and the changed ones
+        # (e.g. matched by a rule) that are still in stock
+        ids = self.catalog.ids
+        if self.in_stock[0] is not self.board.categories:
+            self.in_stock = (self.board.categories, [ids[name] for stock in self.board.categories.values()
+                                                     for name in stock if name in ids])
+        shown = self.subscriptions.watched_among(user_id, self.in_stock[1])
+        shown.update(ids[name] for name in user_changes if name in ids)
+        text = f"🟢 Live stock, updated {datetime.fromtimestamp(self.clock()).strftime('%H:%M:%S')}:\n"
+        return text + (self.board.render_for(ids, shown) or "None of your watched items are in stock right now.")
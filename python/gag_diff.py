@@ -0,0 +1,43 @@
+RESTOCKED = "restocked"
+CHANGED = "changed"
+SOLD_OUT = "sold_out"
+
+
+def diff_stock(previous, current):
+    # previous/current: {name: quantity}; returns {name: (kind, old_qty, new_qty)} for items that moved
+    changes = {}
+    for name, qty in current.items():
+        old = previous.get(name, 0)
+        if qty > 0 and old <= 0:
+            changes[name] = (RESTOCKED, old, qty)
+        elif qty > 0 and qty != old:
+            changes[name] = (CHANGED, old, qty)
+        elif qty <= 0 < old:
+            changes[name] = (SOLD_OUT, old, qty)
+    for name, old in previous.items():
+        if name not in current and old > 0:
+            changes[name] = (SOLD_OUT, old, 0)
+    return changes
+
+
+def merge_changes(earlier, later):
+    # Net change from each item's first old quantity to its latest one; items back where they started drop out
+    merged = dict(earlier)
+    for name, (_, old, qty) in later.items():
+        if name in merged:
+            old = merged[name][1]
+        net = diff_stock({name: old}, {name: qty})
+        if net:
+            merged[name] = net[name]
+        else:
+            merged.pop(name, None)
+    return merged
+
+
+def format_change(name, change):
+    kind, old, qty = change
+    if kind == RESTOCKED:
+        return f"*{name}*: {qty} (restocked)"
+    if kind == CHANGED:
+        return f"*{name}*: {old} → {qty}"
+    return f"*{name}*: sold out"
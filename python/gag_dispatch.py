@@ -0,0 +1,178 @@
+import asyncio
+import os
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from gag_metrics import MESSAGES
+
+
+class TokenBucket:
+    """Global send budget: `rate` tokens per second, bursting up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Dispatcher:
+    """Queue of outgoing messages drained by N workers under global and per-chat rate limits.
+
+    Message kwargs go to bot.send_message unless they name another `method` (e.g. edit_message_text).
+    A `tag` is stripped before the call and passed to `on_sent(chat_id, tag, result)` on success.
+    A `ref` is stripped too and passed to `on_done(ref)` once the message is finished: sent, or failed for good.
+    """
+
+    def __init__(self, bot, workers=None, rate=None, chat_interval=None, max_retries=None, on_blocked=None,
+                 on_sent=None, on_done=None):
+        self.bot = bot
+        self.workers = workers if workers is not None else int(os.getenv("DISPATCH_WORKERS", "16"))
+        self.chat_interval = chat_interval if chat_interval is not None else float(os.getenv("DISPATCH_CHAT_INTERVAL", "1"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("DISPATCH_MAX_RETRIES", "3"))
+        self.bucket = TokenBucket(rate if rate is not None else float(os.getenv("DISPATCH_RATE", "25")))
+        self.on_blocked = on_blocked
+        self.on_sent = on_sent
+        self.on_done = on_done
+        self.queue = asyncio.Queue()
+        self.last_sent = {}
+        self.tasks = []
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, chat_id, **kwargs):
+        self.queue.put_nowait((chat_id, kwargs, 0))
+
+    async def broadcast(self, messages):
+        # messages: iterable of (chat_id, send_message kwargs); returns the run's stats
+        self.start()
+        sent, failed, blocked = self.sent, self.failed, self.blocked
+        started = time.monotonic()
+        for chat_id, kwargs in messages:
+            self.submit(chat_id, **kwargs)
+        queue_depth = self.queue.qsize()
+        await self.queue.join()
+        elapsed = time.monotonic() - started
+        self.last_sent.clear()
+        sent = self.sent - sent
+        return {
+            "sent": sent,
+            "failed": self.failed - failed,
+            "blocked": self.blocked - blocked,
+            "queue_depth": queue_depth,
+            "elapsed": elapsed,
+            "rate": sent / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def stats(self):
+        return {"sent": self.sent, "failed": self.failed, "blocked": self.blocked, "queue_depth": self.queue.qsize()}
+
+    async def _worker(self):
+        while True:
+            chat_id, kwargs, attempt = await self.queue.get()
+            try:
+                finished = await self._send(chat_id, kwargs, attempt)
+            except Exception as e:
+                # A callback or a bad kwarg must not take the worker down; broadcast() would wait forever
+                finished = True
+                self.failed += 1
+                MESSAGES.inc(result="failed")
+                print(f"❌ Failed to notify {chat_id}: {e!r}")
+            try:
+                if finished and self.on_done is not None and kwargs.get("ref") is not None:
+                    self.on_done(kwargs["ref"])
+            except Exception as e:
+                print(f"❌ Failed to record delivery to {chat_id}: {e!r}")
+            finally:
+                self.queue.task_done()
+
+    async def _send(self, chat_id, kwargs, attempt):
+        # Returns False when the message was queued again
+        # Reserve this chat's next slot before waiting so concurrent workers don't double up
+        now = time.monotonic()
+        slot = max(now, self.last_sent.get(chat_id, 0.0) + self.chat_interval)
+        self.last_sent[chat_id] = slot
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        await self.bucket.acquire()
+        method = kwargs.get("method", "send_message")
+        params = {key: value for key, value in kwargs.items() if key not in ("method", "tag", "ref")}
+        try:
+            result = await getattr(self.bot, method)(chat_id=chat_id, **params)
+            self.sent += 1
+            MESSAGES.inc(result="sent")
+            if self.on_sent is not None and kwargs.get("tag") is not None:
+                callback = self.on_sent(chat_id, kwargs["tag"], result)
+                if asyncio.iscoroutine(callback):
+                    await callback
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            self.bucket.pause(retry_after)
+            if attempt < self.max_retries:
+                self.queue.put_nowait((chat_id, kwargs, attempt + 1))
+                MESSAGES.inc(result="retried")
+                return False
+            else:
+                self.failed += 1
+                MESSAGES.inc(result="failed")
+        except Forbidden:
+            self.failed += 1
+            self.blocked += 1
+            MESSAGES.inc(result="blocked")
+            if self.on_blocked is not None:
+                result = self.on_blocked(chat_id)
+                if asyncio.iscoroutine(result):
+                    await result
+        except BadRequest as e:
+            if method != "edit_message_text":
+                self.failed += 1
+                MESSAGES.inc(result="failed")
+                print(f"❌ Failed to notify {chat_id}: {e}")
+            elif "not modified" in e.message:
+                self.sent += 1  # Already shows this text
+                MESSAGES.inc(result="sent")
+            else:
+                # The message to edit is gone (deleted, too old); send a fresh one instead
+                fallback = {key: value for key, value in kwargs.items() if key not in ("method", "message_id")}
+                self.queue.put_nowait((chat_id, fallback, attempt))
+                MESSAGES.inc(result="edit_fallback")
+                return False
+        except TelegramError as e:
+            self.failed += 1
+            MESSAGES.inc(result="failed")
+            print(f"❌ Failed to notify {chat_id}: {e}")
+        return True
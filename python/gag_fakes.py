@@ -0,0 +1,140 @@
+import asyncio
+import bisect
+import json
+import time
+
+from aiohttp import web
+
+
+class _LocalServer:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    def routes(self, app):
+        raise NotImplementedError
+
+    async def start(self):
+        app = web.Application()
+        self.routes(app)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+class FakeTelegramServer(_LocalServer):
+    """Minimal stand-in for the Bot API: accepts every method and answers like Telegram would."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, on_message=None):
+        super().__init__(host, port)
+        self.latency = latency
+        self.on_message = on_message
+        self.calls = {}
+        self.message_id = 0
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/bot"
+
+    def routes(self, app):
+        app.router.add_post('/bot{token}/{method}', self.handle)
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif method == 'getUpdates':
+            await asyncio.sleep(min(float(params.get('timeout') or 0), 1.0))  # Long poll with nothing to deliver
+            result = []
+        elif method in ('sendMessage', 'editMessageText'):
+            self.message_id += 1
+            chat_id = int(params.get('chat_id', 0))
+            result = {
+                "message_id": int(params.get('message_id') or self.message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get('text', ''),
+            }
+            if self.on_message is not None:
+                self.on_message(method, chat_id, params)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+class StockStubServer(_LocalServer):
+    """Serves /api/stock from a list of payloads; `index` selects the one currently served.
+
+    With a `schedule` (one start time per payload, ascending), the payload is picked by `clock()` instead.
+    """
+
+    def __init__(self, payloads, host='127.0.0.1', port=0, schedule=None, clock=time.time):
+        super().__init__(host, port)
+        self.bodies = [json.dumps(payload).encode() for payload in payloads]
+        self.index = 0
+        self.requests = 0
+        self.schedule = schedule
+        self.clock = clock
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/api/stock"
+
+    def routes(self, app):
+        app.router.add_get('/api/stock', self.handle)
+
+    async def handle(self, request):
+        self.requests += 1
+        if self.schedule is not None:
+            self.index = max(bisect.bisect_right(self.schedule, self.clock()) - 1, 0)
+        return web.Response(body=self.bodies[self.index], content_type='application/json')
+
+
+class FeedReplayServer(_LocalServer):
+    """WebSocket stand-in for the realtime stock feed: replays recorded frames to every client."""
+
+    def __init__(self, frames, interval=1.0, host='127.0.0.1', port=0, close_after=False):
+        super().__init__(host, port)
+        self.frames = frames
+        self.interval = interval
+        self.close_after = close_after
+        self.connections = 0
+
+    @property
+    def url(self):
+        return f"ws://{self.host}:{self.port}/ws"
+
+    def routes(self, app):
+        app.router.add_get('/ws', self.handle)
+
+    async def handle(self, request):
+        self.connections += 1
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        try:
+            for frame in self.frames:
+                await ws.send_str(json.dumps(frame))
+                await asyncio.sleep(self.interval)
+            if not self.close_after:
+                async for _ in ws:
+                    pass
+        except ConnectionResetError:
+            pass  # Client went away mid-replay
+        await ws.close()
+        return ws
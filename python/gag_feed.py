@@ -0,0 +1,144 @@
+"""Push-based stock ingestion from the realtime WebSocket feed.
+
+The feed opens with an `initial_data` frame (see go/ex_api.json): category -> list of items with
+`name`, `quantity`, `available` and `lastUpdated`. Later frames (`update`, `stock_update`) carry the
+same shape with only the categories that changed, and each listed category replaces our copy.
+Feed categories (`seeds`, `eggs`, `honey`, ...) are renamed to the /api/stock keys (`seedsStock`,
+`eggStock`, `merchantsStock`, ...) so rules, history and the board see the same keys in both modes.
+
+    python gag_feed.py --serve ../go/ex_api.json     # local stand-in server replaying frames
+    python gag_feed.py --url ws://127.0.0.1:8770/ws  # print changes as they arrive
+"""
+import argparse
+import asyncio
+import json
+from pathlib import Path
+
+import aiohttp
+
+from gag_stock import STOCK_CATEGORIES, resolve_category
+
+UPDATE_TYPES = ("update", "stock_update")
+FEED_CATEGORIES = {"honey": "merchantsStock"}  # The traveling merchant's stock; other names resolve as they are
+
+
+def category_key(name):
+    # Feed category -> /api/stock key; categories the HTTP API does not have keep the same "<name>Stock" form
+    return FEED_CATEGORIES.get(name) or resolve_category(name) or f"{name}Stock"
+
+
+def _is_item_list(value):
+    return isinstance(value, list) and all(isinstance(item, dict) and "name" in item for item in value)
+
+
+def _quantities(items):
+    stock = {}
+    for item in items:
+        if item.get("available", True):
+            stock[item["name"]] = stock.get(item["name"], 0) + (item.get("quantity", 0) or 0)
+    return stock
+
+
+class StockFeed:
+    """Keeps an in-memory stock state in sync with the feed and reconnects with backoff.
+
+    `on_change(snapshot)` is awaited with the flattened {name: quantity} stock whenever it changes.
+    The state survives reconnects, so the `initial_data` frame sent on every reconnect resumes from
+    it and only real differences are passed on.
+    """
+
+    def __init__(self, http, url, on_change, backoff=1.0, max_backoff=60.0):
+        self.http = http
+        self.url = url
+        self.on_change = on_change
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = {}
+        self.live = False
+        self.frames = 0
+        self.reconnects = 0
+        self.last_snapshot = None
+
+    def snapshot(self):
+        current = {}
+        for stock in self.state.values():
+            for name, qty in stock.items():
+                current[name] = current.get(name, 0) + qty
+        return current
+
+    async def run(self):
+        delay = self.backoff
+        while True:
+            try:
+                await self.http.start()
+                async with self.http.session.ws_connect(self.url, heartbeat=30) as ws:
+                    print("🔌 Stock feed connected")
+                    delay = self.backoff
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            await self.handle_frame(json.loads(msg.data))
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                print(f"❌ Stock feed error: {e}")
+            self.live = False
+            self.reconnects += 1
+            print(f"🔌 Stock feed disconnected, retrying in {delay:.0f} s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+    async def handle_frame(self, frame):
+        self.frames += 1
+        kind = frame.get("type")
+        data = frame.get("data") or {}
+        categories = {category_key(cat): _quantities(items) for cat, items in data.items() if _is_item_list(items)}
+        if kind == "initial_data":
+            # Every category, like parse_categories, so a category missing from the frame reads as empty
+            self.state = {cat: {} for cat in STOCK_CATEGORIES} | categories
+            self.live = True
+        elif kind in UPDATE_TYPES:
+            self.state.update(categories)
+        else:
+            return
+        current = self.snapshot()
+        if current != self.last_snapshot:
+            self.last_snapshot = current
+            await self.on_change(current)
+
+
+async def _serve(args):
+    from gag_fakes import FeedReplayServer
+
+    frames = json.loads(Path(args.serve).read_text())
+    server = await FeedReplayServer(frames if isinstance(frames, list) else [frames],
+                                    interval=args.interval, port=args.port).start()
+    print(f"📡 Replaying {args.serve} on {server.url}")
+    await asyncio.Event().wait()
+
+
+async def _listen(args):
+    from gag_http import HttpClient
+
+    async def on_change(snapshot):
+        print(f"📦 {len(snapshot)} items: {snapshot}")
+
+    http = await HttpClient().start()
+    try:
+        await StockFeed(http, args.url, on_change).run()
+    finally:
+        await http.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--serve", metavar="FRAMES", help="JSON file with one frame or a list of frames")
+    group.add_argument("--url", help="feed URL to listen to")
+    parser.add_argument("--port", type=int, default=8770)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between replayed frames")
+    args = parser.parse_args()
+    asyncio.run(_serve(args) if args.serve else _listen(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import statistics
+import time
+from datetime import datetime, timezone
+
+PARTITION_PREFIX = 'stock_history_'
+RESTOCK_PERIOD = 300
+
+
+def partition_name(taken_at):
+    # One table per UTC month, e.g. stock_history_202608; old months are dropped whole
+    return PARTITION_PREFIX + datetime.fromtimestamp(taken_at, timezone.utc).strftime('%Y%m')
+
+
+def create_partition(conn, table):
+    # Keyed by item first so per-item queries are a single range scan
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            item_id INTEGER NOT NULL,
+            taken_at INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            appeared INTEGER NOT NULL,
+            PRIMARY KEY (item_id, taken_at, category_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def partitions(conn):
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ORDER BY name",
+                        (PARTITION_PREFIX + '%',))
+    return [row[0] for row in rows]
+
+
+class StockHistory:
+    """Append-only record of every distinct stock snapshot, written in batches.
+
+    Snapshots are buffered by `record()` on the event loop and written by `write()` on the DB thread.
+    Each row marks whether the item `appeared`, i.e. was absent from the previous snapshot, so
+    restock queries only read the handful of appearance rows.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.last = None
+        self.present = set()
+        self.item_ids = {}
+        self.category_ids = {}
+        self.keys = {}  # casefolded name -> name
+        self.latest = {}  # {name: quantity} of the last recorded snapshot, the baseline after a restart
+
+    def load(self, conn):
+        self.item_ids = {name: item_id for item_id, name in conn.execute('SELECT id, name FROM items')}
+        self.category_ids = {name: cat_id for cat_id, name in conn.execute('SELECT id, name FROM history_categories')}
+        self.keys = {name.casefold(): name for name in self.item_ids}
+        row = conn.execute('SELECT MAX(taken_at) FROM history_snapshots').fetchone()
+        if row[0] is not None:
+            names = {item_id: name for name, item_id in self.item_ids.items()}
+            table = partition_name(row[0])
+            if table in partitions(conn):
+                rows = conn.execute(f'SELECT item_id, quantity FROM {table} WHERE taken_at = ?', (row[0],))
+                self.latest = {names[item_id]: quantity for item_id, quantity in rows}
+                self.present = set(self.latest)
+
+    def record(self, taken_at, categories):
+        # categories: {category: {name: quantity}}; identical consecutive snapshots are skipped
+        snapshot = {cat: dict(stock) for cat, stock in categories.items() if stock}
+        if snapshot == self.last:
+            return False
+        self.last = snapshot
+        present = {name for stock in snapshot.values() for name in stock}
+        rows = [(name, cat, qty, name not in self.present)
+                for cat, stock in snapshot.items() for name, qty in stock.items()]
+        self.present = present
+        self.pending.append((int(taken_at), rows))
+        return True
+
+    def drain(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+    def write(self, conn, pending):
+        # Runs on the DB thread; one executemany per partition
+        if not pending:
+            return 0
+        # Items share the catalog's ids; ones only seen here stay unlisted until the catalog lists them
+        self._intern(conn, 'items', self.item_ids, {name for _, rows in pending for name, _, _, _ in rows},
+                     'INSERT OR IGNORE INTO items (name, listed) VALUES (?, 0)')
+        self._intern(conn, 'history_categories', self.category_ids, {cat for _, rows in pending for _, cat, _, _ in rows},
+                     'INSERT OR IGNORE INTO history_categories (name) VALUES (?)')
+        self.keys.update({name.casefold(): name for name in self.item_ids})
+        by_table = {}
+        for taken_at, rows in pending:
+            by_table.setdefault(partition_name(taken_at), []).extend(
+                (self.item_ids[name], taken_at, self.category_ids[cat], qty, int(appeared))
+                for name, cat, qty, appeared in rows
+            )
+        for table, rows in by_table.items():
+            create_partition(conn, table)
+            conn.executemany(f'INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?, ?)', rows)
+        conn.executemany('INSERT OR REPLACE INTO history_snapshots (taken_at, items) VALUES (?, ?)',
+                         [(taken_at, len(rows)) for taken_at, rows in pending])
+        return len(pending)
+
+    def _intern(self, conn, table, ids, names, insert):
+        missing = [name for name in names if name not in ids]
+        if missing:
+            conn.executemany(insert, [(name,) for name in missing])
+            placeholders = ','.join('?' * len(missing))
+            ids.update({name: row_id for row_id, name in
+                        conn.execute(f'SELECT id, name FROM {table} WHERE name IN ({placeholders})', missing)})
+
+    def resolve(self, name):
+        return self.keys.get(name.strip().casefold())
+
+    def item_stats(self, conn, name, now=None):
+        # Restock frequency for one item; None when it has never been recorded
+        name = self.resolve(name)
+        if name is None:
+            return None
+        now = now or time.time()
+        item_id = self.item_ids[name]
+        appearances = []
+        seen = 0
+        last_seen = None
+        for table in partitions(conn):
+            appearances.extend(row[0] for row in conn.execute(
+                f'SELECT DISTINCT taken_at FROM {table} WHERE item_id = ? AND appeared = 1 ORDER BY taken_at', (item_id,)))
+            count, latest = conn.execute(
+                f'SELECT COUNT(DISTINCT taken_at), MAX(taken_at) FROM {table} WHERE item_id = ?', (item_id,)).fetchone()
+            seen += count
+            last_seen = latest or last_seen
+        if not seen:
+            return None  # Known to the catalog but never recorded in stock
+        first = conn.execute('SELECT MIN(taken_at) FROM history_snapshots').fetchone()[0] or now
+        gaps = [b - a for a, b in zip(appearances, appearances[1:])]
+        median_gap = statistics.median(gaps) if gaps else None
+        next_expected = None
+        if median_gap is not None:
+            next_expected = appearances[-1] + median_gap
+            next_expected += -next_expected % RESTOCK_PERIOD  # Restocks land on period boundaries
+        days = max((now - first) / 86400, 1 / 24)
+        return {
+            "name": name,
+            "appearances": len(appearances),
+            "snapshots_in_stock": seen,
+            "per_day": len(appearances) / days,
+            "tracked_days": days,
+            "last_appeared": appearances[-1] if appearances else None,
+            "last_seen": last_seen,
+            "median_gap": median_gap,
+            "next_expected": next_expected,
+        }
+
+    def prune(self, conn, keep_months):
+        # Drops whole monthly partitions older than keep_months
+        cutoff = datetime.now(timezone.utc)
+        month = cutoff.year * 12 + cutoff.month - 1 - keep_months
+        oldest = PARTITION_PREFIX + f'{month // 12:04d}{month % 12 + 1:02d}'
+        dropped = [table for table in partitions(conn) if table < oldest]
+        for table in dropped:
+            conn.execute(f'DROP TABLE {table}')
+        if dropped:
+            boundary = datetime.strptime(oldest[len(PARTITION_PREFIX):], '%Y%m').replace(tzinfo=timezone.utc)
+            conn.execute('DELETE FROM history_snapshots WHERE taken_at < ?', (int(boundary.timestamp()),))
+        return dropped
+
+
+def format_duration(seconds):
+    seconds = int(abs(seconds))
+    days, rest = divmod(seconds, 86400)
+    hours, rest = divmod(rest, 3600)
+    minutes = rest // 60
+    if seconds < 60:
+        return f"{seconds}s"
+    if days:
+        return f"{days}d {hours}h"
+    if hours:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m"
+
+
+def format_stats(stats, now=None):
+    now = now or time.time()
+    lines = [f"📊 *{stats['name']}*"]
+    if not stats["appearances"]:
+        lines.append(f"Not seen in stock during the last {stats['tracked_days']:.0f} days.")
+        return "\n".join(lines)
+    lines.append(f"Restocks: {stats['appearances']} in {stats['tracked_days']:.1f} days "
+                 f"({stats['per_day']:.2f}/day)")
+    lines.append(f"Last restock: {format_duration(now - stats['last_appeared'])} ago")
+    if stats["median_gap"] is not None:
+        lines.append(f"Median gap: {format_duration(stats['median_gap'])}")
+        remaining = stats["next_expected"] - now
+        if remaining >= 0:
+            lines.append(f"Next expected: in {format_duration(remaining)}")
+        else:
+            lines.append(f"Next expected: overdue by {format_duration(remaining)}")
+    return "\n".join(lines)
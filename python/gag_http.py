@@ -0,0 +1,74 @@
+import asyncio
+import json
+import os
+
+import aiohttp
+
+# Exceptions callers should treat as "request failed"
+REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HttpClient:
+    """Shared aiohttp session with keep-alive pooling, timeouts and retry/backoff."""
+
+    def __init__(self, timeout=None, retries=None, backoff=None, pool_size=None, verify_ssl=True):
+        # Defaults come from the environment at construction time, i.e. after load_dotenv()
+        self.timeout = timeout if timeout is not None else float(os.getenv("HTTP_TIMEOUT", "10"))
+        self.retries = retries if retries is not None else int(os.getenv("HTTP_RETRIES", "2"))
+        self.backoff = backoff if backoff is not None else float(os.getenv("HTTP_BACKOFF", "0.5"))
+        self.pool_size = pool_size if pool_size is not None else int(os.getenv("HTTP_POOL_SIZE", "20"))
+        self.verify_ssl = verify_ssl
+        self.session = None
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ssl=None if self.verify_ssl else False)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def request(self, method, url, **kwargs):
+        # Returns (status, headers, body bytes); retries connection errors and retryable statuses
+        if self.session is None:
+            await self.start()
+        attempt = 0
+        while True:
+            try:
+                async with self.session.request(method, url, **kwargs) as response:
+                    body = await response.read()
+                    if response.status in RETRY_STATUSES and attempt < self.retries:
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history,
+                            status=response.status, message=response.reason or "",
+                        )
+                    response.raise_for_status()
+                    return response.status, response.headers, body
+            except REQUEST_ERRORS as e:
+                if attempt >= self.retries:
+                    raise
+                if isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRY_STATUSES:
+                    raise
+                await asyncio.sleep(self.backoff * (2 ** attempt))
+                attempt += 1
+
+    async def get_json(self, url, **kwargs):
+        _, _, body = await self.request("GET", url, **kwargs)
+        return _loads(body)
+
+    async def post_json(self, url, payload, **kwargs):
+        _, _, body = await self.request("POST", url, json=payload, **kwargs)
+        return _loads(body)
+
+
+def _loads(body):
+    return json.loads(body) if body else None
+
@@ -0,0 +1,147 @@
+import bisect
+import zlib
+from array import array
+from collections import defaultdict
+
+# Per-user flag bits; KNOWN is set once the user has been loaded or added
+KNOWN = 1
+NOTIFIED = 2
+BLOCKED = 4
+STATE = KNOWN | NOTIFIED | BLOCKED
+ACTIVE = KNOWN | NOTIFIED
+
+
+def shard_of(user_id, shards):
+    # Stable across processes and restarts, unlike hash()
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+class SubscriptionIndex:
+    """In-memory item id -> subscribed users, plus each user's notification and blocked flags.
+
+    Users are numbered with dense ordinals: the ones loaded from the users table in id order, then
+    any added later. Each item keeps a sorted array('I') of its subscribers' ordinals and the flags
+    are one byte per ordinal, so memory is a few bytes per watchlist row rather than a set entry and
+    an id string. Ordinals only exist in memory and are reassigned by every load().
+    """
+
+    def __init__(self):
+        self.subscribers = {}  # item_id -> sorted array('I') of ordinals
+        self.user_ids = array('q')  # ordinal -> user id; sorted up to `loaded`
+        self.flags = bytearray()  # ordinal -> KNOWN | NOTIFIED | BLOCKED
+        self.loaded = 0
+        self.added = {}  # user id -> ordinal, for users added after load()
+
+    def load(self, conn, shard=None):
+        # shard: (index, count) to keep only the users hashed to that shard
+        self.load_users(conn, shard)
+        # Rows come in user id order, so each item's ordinals are appended already sorted
+        subscribers = defaultdict(lambda: array('I'))
+        current, ordinal = None, None
+        for user_id, item_id in conn.execute('SELECT user_id, item_id FROM watchlist ORDER BY user_id'):
+            if user_id != current:
+                current, ordinal = user_id, self.ordinal(user_id)
+            if ordinal is not None:
+                subscribers[item_id].append(ordinal)
+        self.subscribers = dict(subscribers)
+
+    def load_users(self, conn, shard=None):
+        keep = (lambda user_id: shard_of(user_id, shard[1]) == shard[0]) if shard else (lambda user_id: True)
+        user_ids, flags = array('q'), bytearray()
+        for user_id, is_notified, is_blocked in conn.execute('SELECT id, is_notified, is_blocked FROM users ORDER BY id'):
+            if keep(user_id):
+                user_ids.append(user_id)
+                flags.append(KNOWN | (NOTIFIED if is_notified else 0) | (BLOCKED if is_blocked else 0))
+        self.user_ids, self.flags, self.loaded, self.added = user_ids, flags, len(user_ids), {}
+
+    def ordinal(self, user_id, create=False):
+        # Dense number for user_id; None when unknown unless create
+        i = bisect.bisect_left(self.user_ids, user_id, 0, self.loaded)
+        if i < self.loaded and self.user_ids[i] == user_id:
+            return i
+        ordinal = self.added.get(user_id)
+        if ordinal is None and create:
+            ordinal = self.added[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.flags.append(0)
+        return ordinal
+
+    def _flags(self, user_id):
+        ordinal = self.ordinal(int(user_id))
+        return 0 if ordinal is None else self.flags[ordinal]
+
+    def user_count(self):
+        return sum(1 for flags in self.flags if flags & KNOWN)
+
+    def is_notified(self, user_id):
+        # None for users the index has never seen
+        flags = self._flags(user_id)
+        return bool(flags & NOTIFIED) if flags & KNOWN else None
+
+    def is_blocked(self, user_id):
+        return bool(self._flags(user_id) & BLOCKED)
+
+    def is_active(self, user_id):
+        # Notified and not blocked: the users broadcasts go to
+        return self._flags(user_id) & STATE == ACTIVE
+
+    def add_user(self, user_id, is_notified=True):
+        ordinal = self.ordinal(int(user_id), create=True)
+        if not self.flags[ordinal] & KNOWN:
+            self.flags[ordinal] |= KNOWN | (NOTIFIED if is_notified else 0)
+
+    def set_notified(self, user_id, is_notified):
+        ordinal = self.ordinal(int(user_id), create=True)
+        self.flags[ordinal] = (self.flags[ordinal] & ~NOTIFIED) | KNOWN | (NOTIFIED if is_notified else 0)
+
+    def set_blocked(self, user_id, is_blocked):
+        ordinal = self.ordinal(int(user_id), create=is_blocked)
+        if ordinal is not None:
+            self.flags[ordinal] = (self.flags[ordinal] & ~BLOCKED) | (BLOCKED if is_blocked else 0)
+
+    def subscribe(self, user_id, item_id):
+        ordinal = self.ordinal(int(user_id), create=True)
+        ordinals = self.subscribers.get(item_id)
+        if ordinals is None:
+            self.subscribers[item_id] = array('I', [ordinal])
+            return
+        i = bisect.bisect_left(ordinals, ordinal)
+        if i == len(ordinals) or ordinals[i] != ordinal:
+            ordinals.insert(i, ordinal)
+
+    def unsubscribe(self, user_id, item_id):
+        ordinal = self.ordinal(int(user_id))
+        ordinals = self.subscribers.get(item_id)
+        if ordinal is None or ordinals is None:
+            return
+        i = bisect.bisect_left(ordinals, ordinal)
+        if i < len(ordinals) and ordinals[i] == ordinal:
+            del ordinals[i]
+            if not ordinals:
+                del self.subscribers[item_id]
+
+    def watched_among(self, user_id, item_ids):
+        # The subset of item_ids the user watches, without a per-user watchlist
+        ordinal = self.ordinal(int(user_id))
+        if ordinal is None:
+            return set()
+        watched = set()
+        for item_id in item_ids:
+            ordinals = self.subscribers.get(item_id, ())
+            i = bisect.bisect_left(ordinals, ordinal)
+            if i < len(ordinals) and ordinals[i] == ordinal:
+                watched.add(item_id)
+        return watched
+
+    def match(self, in_stock):
+        # in_stock: {item_id: item_name}; returns {user_id: [item_name, ...]} for notified users
+        matches = defaultdict(list)
+        flags, user_ids = self.flags, self.user_ids
+        for item_id, item_name in in_stock.items():
+            for ordinal in self.subscribers.get(item_id, ()):
+                if flags[ordinal] & STATE == ACTIVE:
+                    matches[user_ids[ordinal]].append(item_name)
+        return matches
+
+    def notified_users(self):
+        return [self.user_ids[ordinal] for ordinal, flags in enumerate(self.flags) if flags & STATE == ACTIVE]
@@ -0,0 +1,85 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+
+def _main_keyboard(is_notified):
+    keyboard = [
+        [InlineKeyboardButton("Add Item to Watchlist", callback_data='btn_add')],
+        [InlineKeyboardButton("Remove Item from Watchlist", callback_data='btn_remove')],
+        [InlineKeyboardButton("View Watchlist", callback_data='view_watchlist')],
+    ]
+    if is_notified:
+        keyboard.append([InlineKeyboardButton("Disable Notifications", callback_data='disable_notifications')])
+    else:
+        keyboard.append([InlineKeyboardButton("Enable Notifications", callback_data='enable_notifications')])
+    return InlineKeyboardMarkup(keyboard)
+
+
+# Keyed by the user's notification flag
+MAIN_KEYBOARDS = {True: _main_keyboard(True), False: _main_keyboard(False)}
+
+CANCEL_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data='btn_cancel')]])
+
+# Manual entry prompt: opens inline search in the current chat
+SEARCH_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔎 Search items", switch_inline_query_current_chat='')],
+    [InlineKeyboardButton("Cancel", callback_data='btn_cancel')],
+])
+
+
+def suggestions_keyboard(names):
+    keyboard = [[InlineKeyboardButton(name, callback_data=f'item_{name}')] for name in names]
+    keyboard.append([InlineKeyboardButton("Cancel", callback_data='btn_cancel')])
+    return InlineKeyboardMarkup(keyboard)
+
+PAGE_MODES = {
+    'add': ("Choose an item to add to your watchlist or add manually:",
+            InlineKeyboardButton("➕ Add Manually", callback_data='add_manual')),
+    'remove': ("Choose an item to REMOVE from your watchlist or remove manually:",
+               InlineKeyboardButton("➖ Remove Manually", callback_data='remove_manual')),
+}
+
+
+class CatalogPages:
+    """Paginated item keyboards for each PAGE_MODES entry, rebuilt only when the catalog version changes."""
+
+    def __init__(self, catalog, per_page):
+        self.catalog = catalog
+        self.per_page = per_page
+        self.version = None
+        self.pages = {}
+
+    def get(self, mode, page):
+        # Returns (text, markup, page) with page clamped to the available range
+        if self.version != self.catalog.version:
+            self._build()
+        pages = self.pages[mode]
+        page = min(max(page, 0), len(pages) - 1)
+        return PAGE_MODES[mode][0], pages[page], page
+
+    def _build(self):
+        names = self.catalog.names
+        last_page = max(len(names) - 1, 0) // self.per_page
+        self.pages = {
+            mode: [self._page(names, top_button, page, last_page) for page in range(last_page + 1)]
+            for mode, (_, top_button) in PAGE_MODES.items()
+        }
+        self.version = self.catalog.version
+
+    def _page(self, names, top_button, page, last_page):
+        start_idx = page * self.per_page
+        keyboard = [[top_button]]
+        for item_name in names[start_idx:start_idx + self.per_page]:
+            keyboard.append([InlineKeyboardButton(item_name, callback_data=f'item_{item_name}')])
+
+        nav_buttons = []
+        if page > 0:
+            nav_buttons.append(InlineKeyboardButton("⏮️ First", callback_data='page_0'))
+            nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f'page_{page-1}'))
+        if page < last_page:
+            nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f'page_{page+1}'))
+            nav_buttons.append(InlineKeyboardButton("⏭️ Last", callback_data=f'page_{last_page}'))
+        if nav_buttons:
+            keyboard.append(nav_buttons)
+
+        keyboard.append([InlineKeyboardButton("Cancel", callback_data='btn_cancel')])
+        return InlineKeyboardMarkup(keyboard)
@@ -0,0 +1,276 @@
+"""In-process metrics in the Prometheus text format, a local /metrics endpoint and a sampling profiler.
+
+Set METRICS_PORT to serve http://127.0.0.1:METRICS_PORT/metrics. `GET /profile` arms the profiler,
+which then samples every thread for the next poll cycle and writes the stacks in folded format
+(flamegraph.pl / speedscope) to PROFILE_DIR.
+"""
+import contextvars
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter as _Counts
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Name of the bot handler the current task is running, for per-handler DB metrics
+current_handler = contextvars.ContextVar("current_handler", default="background")
+
+_metrics = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, key, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self.samples():
+            lines.append(f"{name}{_label_text(self.labels, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def set_function(self, function):
+        # Read the value when scraped, e.g. a queue size
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            self.values[()] = self.function()
+        return super().samples()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_label_text(self.labels, key, [le])} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_label_text(self.labels, key, [le])} {count}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {count}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+FETCH_SECONDS = Histogram("gag_fetch_seconds", "Upstream /api/stock request latency")
+FETCH_RESULTS = Counter("gag_fetch_total", "Stock fetches by outcome", ("result",))
+PAYLOAD_BYTES = Histogram("gag_payload_bytes", "Size of /api/stock response bodies", buckets=SIZE_BUCKETS)
+PARSE_SECONDS = Histogram("gag_parse_seconds", "Time to parse a stock payload into a snapshot")
+COMBINE_SECONDS = Histogram("gag_combine_items_seconds", "Time spent in combine_items per parsed payload")
+DB_QUERIES = Counter("gag_db_queries_total", "Database calls by handler and query", ("handler", "query"))
+DB_SECONDS = Histogram("gag_db_query_seconds", "Database call latency including executor wait", ("handler",))
+HANDLER_SECONDS = Histogram("gag_handler_seconds", "Bot handler latency; callbacks are labelled by callback_data type",
+                            ("handler",))
+FANOUT_SECONDS = Histogram("gag_fanout_seconds", "Time to deliver one stock change to every matched user",
+                           buckets=DEFAULT_BUCKETS + (30.0, 60.0, 120.0, 300.0))
+MESSAGES = Counter("gag_messages_total", "Notification sends by result", ("result",))
+QUEUE_DEPTH = Gauge("gag_dispatch_queue_depth", "Messages waiting in the dispatcher queue")
+
+
+def track_handler(name):
+    """Decorator timing a bot handler; `name` is a string or a function of the update."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            label = name(update) if callable(name) else name
+            token = current_handler.set(label)
+            try:
+                with HANDLER_SECONDS.time(handler=label):
+                    return await handler(update, context)
+            finally:
+                current_handler.reset(token)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads from a background thread while active.
+
+    `arm()` requests a capture; wrap one unit of work in `cycle()` and the capture covers exactly it.
+    """
+
+    def __init__(self, interval=None, out_dir=None):
+        self.interval = interval if interval is not None else float(os.getenv("PROFILE_INTERVAL", "0.005"))
+        self.out_dir = Path(out_dir or os.getenv("PROFILE_DIR", "."))
+        self.armed = False
+        self.stacks = _Counts()
+        self.samples = 0
+        self.last_path = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def arm(self):
+        self.armed = True
+
+    @contextmanager
+    def cycle(self):
+        if not self.armed:
+            yield
+            return
+        self.armed = False
+        self.start()
+        try:
+            yield
+        finally:
+            self.stop()
+            self.dump()
+
+    def start(self):
+        self.stacks.clear()
+        self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def dump(self):
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        path = self.out_dir / f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+        path.write_text("".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()))
+        self.last_path = path
+        print(f"🔬 Profiled one cycle: {self.samples} samples written to {path}")
+        return path
+
+
+class MetricsServer:
+    """Serves /metrics and /profile, bound to localhost by default."""
+
+    def __init__(self, profiler, port=None, host=None):
+        self.profiler = profiler
+        self.port = port if port is not None else int(os.getenv("METRICS_PORT", "0"))
+        self.host = host or os.getenv("METRICS_HOST", "127.0.0.1")
+        self.runner = None
+
+    async def start(self):
+        from aiohttp import web  # Only when serving; importing the metrics stays cheap
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        app.router.add_get("/profile", self.handle_profile)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        print(f"📈 Metrics on http://{self.host}:{self.port}/metrics")
+        return self
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_metrics(self, request):
+        from aiohttp import web
+
+        return web.Response(text=render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def handle_profile(self, request):
+        from aiohttp import web
+
+        self.profiler.arm()
+        return web.Response(text="Profiler armed for the next poll cycle\n")
@@ -1,19 +1,20 @@
+import argparse
 import asyncio
 import json
-import requests
-from collections import defaultdict
 from pathlib import Path
-from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from gag_core import STOCK_URL, StockEngine, check_time
+from gag_diff import format_change
+from gag_http import HttpClient, REQUEST_ERRORS
 import os
 
 # === CONFIG ===
-load_dotenv()  # Load environment variables from .env file
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 WATCHLIST_FILE = "gag_watchlist.json"
-
-previous_stock = {}
+TELEGRAM_BOT_TOKEN = None
+TELEGRAM_CHAT_ID = None
+TELEGRAM_BASE_URL = "https://api.telegram.org/bot"
+http = None
+engine = None
 
 def load_watchlist():
     path = Path(WATCHLIST_FILE)
@@ -26,104 +27,74 @@ def load_watchlist():
         return set()
 
 async def send_telegram_notification(message: str):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    url = f"{TELEGRAM_BASE_URL}{TELEGRAM_BOT_TOKEN}/sendMessage"
     payload = {"chat_id": TELEGRAM_CHAT_ID, "text": message, "parse_mode": "Markdown"}
     try:
-        response = requests.post(url, json=payload, timeout=10, verify=False)
-        response.raise_for_status()
+        await http.post_json(url, payload)
         print("✅ Notification sent successfully.")
-    except requests.RequestException as e:
+    except REQUEST_ERRORS as e:
         print(f"❌ Failed to send notification: {e}")
         # Optionally, you can log this error to a file or database for further analysis
 
-def combine_items(items, key_qty="value"):
-    d = defaultdict(int)
-    for item in items:
-        name = item.get("name")
-        qty = item.get(key_qty, 0) or 0
-        d[name] += qty
-    return [{"name": name, "quantity": qty} for name, qty in d.items()]
-
-def seconds_until_next_5_min_offset_1():
-    now = datetime.now()
-    minute = ((now.minute // 5) + 1) * 5 + 1
-    hour = now.hour + (minute // 60)
-    minute %= 60
-    hour %= 24
-    next_t = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
-    delta = (next_t - now).total_seconds()
-    if delta <= 0:
-        # Add 5 minutes to ensure positive sleep time
-        next_t += timedelta(minutes=5)
-        delta = (next_t - now).total_seconds()
-    return delta
-
-def seconds_until_next_5_min_offset_30():
-    now = datetime.now()
-    # Find the next minute that is a multiple of 5 (e.g., 30, 35, 40, ...)
-    next_minute = ((now.minute // 5) + 1) * 5
-    hour = now.hour + (next_minute // 60)
-    next_minute %= 60
-    hour %= 24
-    # Set seconds to 30
-    next_t = now.replace(hour=hour, minute=next_minute, second=30, microsecond=0)
-    # If the next time is in the past (i.e., it's already xx:yy:30), add 5 minutes
-    if next_t <= now:
-        next_t = next_t.replace(minute=(next_t.minute + 5) % 60)
-        if next_t.minute < now.minute:
-            next_t = next_t.replace(hour=(next_t.hour + 1) % 24)
-    return (next_t - now).total_seconds()
-
 async def check_stock_once(check_at=None):
-    url = "https://growagarden.gg/api/stock"
     try:
-        response = requests.get(url, timeout=10, verify=False)
-        response.raise_for_status()
-        data = response.json()
+        data, categories = await engine.poll()
+        if categories is None:
+            print(f"♻️ Stock unchanged, skipping ({engine.fetcher.stats})")
+            return data
+
+        # Advance the baseline even with an empty watchlist, so items added later are not reported as restocked
+        _, changes = engine.advance(categories)
 
         watchlist = load_watchlist()
         if not watchlist:
             print("⚠️ Watchlist is empty.")
-            return
+            return data
 
-        current = {}
-        # categories that have ‘value’
-        for cat in ("gearStock", "seedsStock", "cosmeticsStock", "eggStock", "merchantsStock",
-                    "easterStock", "nightStock", "eventStock"):
-            items = combine_items(data.get(cat, []))
-            for it in items:
-                current[it["name"]] = it["quantity"]
+        # Only report watched items whose stock moved since the previous check
 
-        message = f"📦 Stock check at {check_at}:\n"
+        watched_changes = [name for name in watchlist if name in changes]
+        if not watched_changes:
+            print("📦 No stock changes on watchlist items.")
+            return data
 
-        for name in watchlist:
-            qty = current.get(name, 0)
-            if qty > 0:
-                message += f"*{name}*: {qty}\n"
+        message = f"📦 Stock update at {check_at}:\n"
+        for name in watched_changes:
+            message += format_change(name, changes[name]) + "\n"
 
-        if message.strip() == f"📦 Stock check at {check_at}:":
-            print("📦 No items in stock from watchlist.")
-            return
-        
         print(message.strip())
         await send_telegram_notification(message.strip())
-        previous_stock.update(current)
+        return data
 
     except Exception as e:
+        engine.fetcher.reset()
         print(f"❌ Fetch error: {e}")
         await send_telegram_notification(f"Error fetching stock: {e}")
 
-async def main_loop():
+async def main_loop(once=False):
+    await http.start()
     try:
-        while True:
-            now = datetime.now().strftime("%H:%M:%S")
-            print(f"⏰ Check at {now}")
-            await check_stock_once(check_at=now)
-            wait = seconds_until_next_5_min_offset_1()
-            print(f"🕒 Sleep for {int(wait)} s")
-            await asyncio.sleep(wait)
+        if once:
+            await check_stock_once(check_at=check_time())
+        else:
+            await engine.run(check_stock_once)
     except KeyboardInterrupt:
         print("🔴 Stopping the notifier.")
+    finally:
+        await http.close()
+
+def main(argv=None):
+    global TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, TELEGRAM_BASE_URL, http, engine
+    parser = argparse.ArgumentParser(description="Notify one Telegram chat about watched items in gag_watchlist.json.")
+    parser.add_argument("--once", action="store_true", help="check the stock once and exit")
+    args = parser.parse_args(argv)
+    load_dotenv()  # Load environment variables from .env file
+    TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+    TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+    TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL") or TELEGRAM_BASE_URL
+    http = HttpClient(verify_ssl=False)
+    engine = StockEngine(http, os.getenv("STOCK_URL") or STOCK_URL)
+    asyncio.run(main_loop(once=args.once))
 
 if __name__ == "__main__":
-    asyncio.run(main_loop())
+    main()
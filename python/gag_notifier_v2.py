@@ -1,143 +1,151 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, error
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
+from telegram import Update, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent, error
+from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, InlineQueryHandler, MessageHandler, filters
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
-from collections import defaultdict
+from gag_catalog import Catalog
+from gag_core import STOCK_URL, StockEngine, changed_items, check_time
+from gag_db import Database
+from gag_delivery import DELIVERY_MODES, LIVE, MAX_DIGEST_MINUTES, Delivery
+from gag_dispatch import Dispatcher
+from gag_http import HttpClient, REQUEST_ERRORS
+from gag_index import SubscriptionIndex, shard_of
+from gag_keyboards import MAIN_KEYBOARDS, SEARCH_KEYBOARD, CatalogPages, suggestions_keyboard
+from gag_outbox import Outbox
+from gag_metrics import FANOUT_SECONDS, QUEUE_DEPTH, SamplingProfiler, track_handler
+from gag_rules import MAX_RULES, RuleMatcher, describe_rule, parse_rule
+from gag_search import SearchIndex
+from gag_shard import ShardedIndex, ShardPool
+from gag_history import StockHistory, format_duration, format_stats
+from gag_users import UserCache
+from gag_stock import StockBoard
+from urllib.parse import urlparse
+import argparse
 import os
-import sqlite3
-import requests
 import asyncio
+import json
+import secrets
+import time
+import gag_db
 
 
 # Config
-load_dotenv()
-TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-TELEGRAM_ERROR_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 ITEMS_PER_PAGE = 5
-conn = sqlite3.connect('gag_notifier.db')
+FEED_POLL_CHECK = 5
+CALLBACK_PREFIXES = ('page_', 'item_')
+MAX_IMPORT_BYTES = 64 * 1024
+SUGGESTION_LIMIT = 6
+INLINE_RESULTS = 20
+DIGEST_CHECK_INTERVAL = 30
+
+
+class Config:
+    """Settings from the environment, read in main() after load_dotenv(); command-line flags override them."""
+
+    def __init__(self, args=None):
+        self.token = os.getenv("TELEGRAM_BOT_TOKEN")
+        self.base_url = os.getenv("TELEGRAM_BASE_URL")  # Bot API server, e.g. a local one; Telegram's when unset
+        self.stock_url = os.getenv("STOCK_URL") or STOCK_URL
+        self.catalog_ttl = int(os.getenv("CATALOG_TTL", "600"))
+        self.stock_ws_url = os.getenv("STOCK_WS_URL")  # Optional realtime feed; HTTP polling is the fallback
+        self.webhook_url = os.getenv("WEBHOOK_URL")  # Public HTTPS URL; long polling is used when unset
+        self.webhook_secret = os.getenv("WEBHOOK_SECRET")
+        self.webhook_host = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+        self.webhook_port = int(os.getenv("WEBHOOK_PORT", "8443"))
+        self.metrics_port = os.getenv("METRICS_PORT")  # Serves /metrics on localhost when set
+        self.history_flush_interval = int(os.getenv("HISTORY_FLUSH_INTERVAL", "60"))
+        self.notify_shards = int(os.getenv("NOTIFY_SHARDS", "0"))  # Worker processes for matching and sending; 0 keeps it in-process
+        self.user_flush_interval = float(os.getenv("USER_FLUSH_INTERVAL", "5"))
+        self.history_months = int(os.getenv("HISTORY_MONTHS", "0"))  # Monthly partitions to keep; 0 keeps everything
+        self.outbox_flush_interval = float(os.getenv("OUTBOX_FLUSH_INTERVAL", "1"))
+        self.outbox_max_age = int(os.getenv("OUTBOX_MAX_AGE", "300"))  # Undelivered notifications older than this are not resumed
+        self.once = False
+        if args is not None:
+            self.once = args.once
+            if args.webhook_url is not None:
+                self.webhook_url = args.webhook_url
+            if args.shards is not None:
+                self.notify_shards = args.shards
+            if args.metrics_port is not None:
+                self.metrics_port = args.metrics_port
+
+
+# Built by setup(); importing this module opens nothing and connects to nothing
+config = None
+http = None
+db = None
+engine = None
+subscriptions = None
+catalog = None
+catalog_pages = None
+search_index = None
+users = None
+delivery = None
+outbox = None
+profiler = None
+app = None
+clock = time.time
 
 current_stock = {}
-previous_stock = {}
-
-# Create a table if it doesn't exist
-conn.execute('CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
-conn.execute('CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, username TEXT, is_notified INTEGER DEFAULT 1)')
-conn.execute('CREATE TABLE IF NOT EXISTS watchlist (user_id TEXT, item_id INTEGER, FOREIGN KEY(user_id) REFERENCES users(id), FOREIGN KEY(item_id) REFERENCES items(id))')
-conn.commit()
-conn.close()
-
+board = StockBoard()  # Latest snapshot, pre-rendered for /stock and /mystock
+rules = RuleMatcher()
+dispatcher = None
+shard_pool = None
+feed = None
+snapshot_lock = asyncio.Lock()
+history = StockHistory()
+metrics_server = None
+
+def callback_kind(update: Update) -> str:
+    # Metrics label for a callback: its callback_data without the page number or item name
+    data = update.callback_query.data or ''
+    for prefix in CALLBACK_PREFIXES:
+        if data.startswith(prefix):
+            return f"callback:{prefix[:-1]}"
+    return f"callback:{data}"
+
+@track_handler("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    conn = sqlite3.connect('gag_notifier.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)', (user.id, user.username))
-    conn.commit()
-    
-    # Create inline keyboard
-    keyboard = [
-        [InlineKeyboardButton("Add Item to Watchlist", callback_data='btn_add')],
-        [InlineKeyboardButton("Remove Item from Watchlist", callback_data='btn_remove')],
-        [InlineKeyboardButton("View Watchlist", callback_data='view_watchlist')],
-    ]
-
-    cursor.execute('SELECT is_notified FROM users WHERE id = ?', (user.id,))
-    is_notified = cursor.fetchone()
-    if is_notified and is_notified[0] == 0:
-        keyboard.append([InlineKeyboardButton("Enable Notifications", callback_data='enable_notifications')])
-    else:
-        keyboard.append([InlineKeyboardButton("Disable Notifications", callback_data='disable_notifications')])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    users.register(user.id, user.username)
 
     await update.message.reply_text(
         f'Hello @{user.first_name}, you can now use the bot!',
-        reply_markup=reply_markup
+        reply_markup=get_keyboard(update)
     )
 
 def get_keyboard(update: Update) -> InlineKeyboardMarkup:
-    user = update.effective_user
-    conn = sqlite3.connect('gag_notifier.db')
-    cursor = conn.cursor()
-    keyboard = [
-        [InlineKeyboardButton("Add Item to Watchlist", callback_data='btn_add')],
-        [InlineKeyboardButton("Remove Item from Watchlist", callback_data='btn_remove')],
-        [InlineKeyboardButton("View Watchlist", callback_data='view_watchlist')],
-    ]
-    cursor.execute('SELECT is_notified FROM users WHERE id = ?', (user.id,))
-    is_notified = cursor.fetchone()
-    if is_notified and is_notified[0] == 0:
-        keyboard.append([InlineKeyboardButton("Enable Notifications", callback_data='enable_notifications')])
-    else:
-        keyboard.append([InlineKeyboardButton("Disable Notifications", callback_data='disable_notifications')])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    return reply_markup
+    # Answered from the user cache, no query needed
+    return MAIN_KEYBOARDS[users.is_notified(update.effective_user.id)]
+
+def mark_blocked(user_id):
+    # Called by the dispatcher when Telegram answers Forbidden; skip this chat in later broadcasts
+    users.set_blocked(user_id, True)
 
 def set_notification_status(user_id: int, status: int):
-    conn = sqlite3.connect('gag_notifier.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET is_notified = ? WHERE id = ?', (status, user_id))
-    conn.commit()
-    conn.close()
+    # Cached; written to the users table by the next flush
+    users.set_notified(user_id, status)
 
+@track_handler(callback_kind)
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    update_items()
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
 
-    # Get current page from context, default to 0
-    page = context.user_data.get('items_page', 0)
-
-    if query.data == 'btn_add' or query.data.startswith('page_'):
-        set_notification_status(user_id, 0)  # Disable notifications for adding items
-        # If navigating, update page
-        if query.data.startswith('page_'):
-            page = int(query.data.split('_')[1])
-            context.user_data['items_page'] = page
-        else:
-            page = 0
-            context.user_data['items_page'] = page
-
-        # Fetch items from DB
-        conn = sqlite3.connect('gag_notifier.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT name FROM items ORDER BY name ASC')
-        items = [item[0] for item in cursor.fetchall()]
-        conn.close()
-
-        # Pagination logic
-        start_idx = page * ITEMS_PER_PAGE
-        end_idx = start_idx + ITEMS_PER_PAGE
-        page_items = items[start_idx:end_idx]
-
-        keyboard = []
-        # Add "Add Manually" at the top
-        keyboard.append([InlineKeyboardButton("➕ Add Manually", callback_data='add_manual')])
-        # Add item buttons
-        for item_name in page_items:
-            keyboard.append([InlineKeyboardButton(item_name, callback_data=f'item_{item_name}')])
-
-        # Pagination buttons
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(InlineKeyboardButton("⏮️ First", callback_data='page_0'))
-            nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f'page_{page-1}'))
-        if end_idx < len(items):
-            last_page = (len(items) - 1) // ITEMS_PER_PAGE
-            nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f'page_{page+1}'))
-            nav_buttons.append(InlineKeyboardButton("⏭️ Last", callback_data=f'page_{last_page}'))
-        if nav_buttons:
-            keyboard.append(nav_buttons)
-
-        keyboard.append([InlineKeyboardButton("Cancel", callback_data='btn_cancel')])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        await query.edit_message_text(
-            text="Choose an item to add to your watchlist or add manually:",
-            reply_markup=reply_markup
-        )
+    if query.data in ('btn_add', 'btn_remove'):
+        # Disable notifications while editing the watchlist
+        set_notification_status(user_id, 0)
+        mode = 'add' if query.data == 'btn_add' else 'remove'
+        context.user_data['items_mode'] = mode
+        context.user_data['awaiting_remove_item'] = mode == 'remove'
+        text, reply_markup, page = catalog_pages.get(mode, 0)
+        context.user_data['items_page'] = page
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+
+    elif query.data.startswith('page_'):
+        # Pagination is served entirely from the prebuilt pages
+        mode = context.user_data.get('items_mode', 'add')
+        text, reply_markup, page = catalog_pages.get(mode, int(query.data.split('_')[1]))
+        context.user_data['items_page'] = page
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
 
     elif query.data == 'btn_cancel':
         set_notification_status(user_id, 1)  # Re-enable notifications
@@ -147,317 +155,321 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     elif query.data.startswith('item_'):
         item_name = query.data[5:]
-        conn = sqlite3.connect('gag_notifier.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT id FROM items WHERE name = ?', (item_name,))
-        item_row = cursor.fetchone()
-        if item_row:
-            item_id = item_row[0]
+        item_id = catalog.ids.get(item_name)
+        if item_id is not None:
             set_notification_status(user_id, 1)  # Re-enable notifications after manual item handling
-            if context.user_data.get('awaiting_remove_item'):
-                cursor.execute('DELETE FROM watchlist WHERE user_id = ? AND item_id = ?', (str(user_id), item_id))
-                if cursor.rowcount > 0:
+            if context.user_data.get('items_mode') == 'remove':
+                if await db.run(gag_db.remove_watch, user_id, item_id):
+                    subscriptions.unsubscribe(user_id, item_id)
+                    users.watch_changed(user_id, -1)
                     await query.edit_message_text(text=f"✅ Removed '{item_name}' from your watchlist.", reply_markup=get_keyboard(update))
                 else:
                     await query.edit_message_text(text=f"❌ '{item_name}' is not in your watchlist.", reply_markup=get_keyboard(update))
             else:
-                cursor.execute('SELECT 1 FROM watchlist WHERE user_id = ? AND item_id = ?', (str(user_id), item_id))
-                exists = cursor.fetchone()
-                if exists:
-                    await query.edit_message_text(text=f"⚠️ '{item_name}' is already in your watchlist.", reply_markup=get_keyboard(update))
-                else:
-                    cursor.execute('INSERT OR IGNORE INTO watchlist (user_id, item_id) VALUES (?, ?)', (str(user_id), item_id))
-                    conn.commit()
+                if await db.run(gag_db.add_watch, user_id, item_id):
+                    subscriptions.subscribe(user_id, item_id)
+                    users.watch_changed(user_id, 1)
                     await query.edit_message_text(text=f"✅ Added '{item_name}' to your watchlist.", reply_markup=get_keyboard(update))
+                else:
+                    await query.edit_message_text(text=f"⚠️ '{item_name}' is already in your watchlist.", reply_markup=get_keyboard(update))
         else:
             await query.edit_message_text(text="❌ Item not found.", reply_markup=get_keyboard(update))
-        conn.close()
         context.user_data['items_page'] = 0  # Reset page
 
     elif query.data == 'add_manual':
         context.user_data['awaiting_manual_item'] = True
-        await query.edit_message_text(text="Please send the item name you want to add(e.g. Grandmaster Sprinkler OR Grandmaster Sprinkler,Beanstalk ):", reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Cancel", callback_data='btn_cancel')]
-        ]))
+        context.user_data['items_mode'] = 'add'
+        await query.edit_message_text(text="Please send the item name you want to add(e.g. Grandmaster Sprinkler OR Grandmaster Sprinkler,Beanstalk ):", reply_markup=SEARCH_KEYBOARD)
         context.user_data['items_page'] = 0  # Reset page
     
     elif query.data == 'remove_manual':
         context.user_data['awaiting_remove_item'] = True
-        await query.edit_message_text(text="Please send the item name you want to remove(e.g. Grandmaster Sprinkler OR Grandmaster Sprinkler,Beanstalk ):", reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Cancel", callback_data='btn_cancel')]
-        ]))
+        context.user_data['items_mode'] = 'remove'
+        await query.edit_message_text(text="Please send the item name you want to remove(e.g. Grandmaster Sprinkler OR Grandmaster Sprinkler,Beanstalk ):", reply_markup=SEARCH_KEYBOARD)
         context.user_data['items_page'] = 0  # Reset page
 
-    elif query.data == 'btn_remove' or query.data.startswith('page_'):
-        set_notification_status(user_id, 0)  # Disable notifications for removing items
-        context.user_data['awaiting_remove_item'] = True
-        # If navigating, update page
-        if query.data.startswith('page_'):
-            page = int(query.data.split('_')[1])
-            context.user_data['items_page'] = page
-        else:
-            page = 0
-            context.user_data['items_page'] = page
-
-        # Fetch items from DB
-        conn = sqlite3.connect('gag_notifier.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT name FROM items ORDER BY name ASC')
-        items = [item[0] for item in cursor.fetchall()]
-        conn.close()
-
-        # Pagination logic
-        start_idx = page * ITEMS_PER_PAGE
-        end_idx = start_idx + ITEMS_PER_PAGE
-        page_items = items[start_idx:end_idx]
-
-        keyboard = []
-        # Add "Remove Manually" at the top
-        keyboard.append([InlineKeyboardButton("➖ Remove Manually", callback_data='remove_manual')])
-        # Add item buttons
-        for item_name in page_items:
-            keyboard.append([InlineKeyboardButton(item_name, callback_data=f'item_{item_name}')])
-
-        # Pagination buttons
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(InlineKeyboardButton("⏮️ First", callback_data='page_0'))
-            nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f'page_{page-1}'))
-        if end_idx < len(items):
-            last_page = (len(items) - 1) // ITEMS_PER_PAGE
-            nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f'page_{page+1}'))
-            nav_buttons.append(InlineKeyboardButton("⏭️ Last", callback_data=f'page_{last_page}'))
-        if nav_buttons:
-            keyboard.append(nav_buttons)
-
-        keyboard.append([InlineKeyboardButton("Cancel", callback_data='btn_cancel')])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        await query.edit_message_text(
-            text="Choose an item to REMOVE from your watchlist or remove manually:",
-            reply_markup=reply_markup
-        )
     elif query.data == 'view_watchlist':
-        conn = sqlite3.connect('gag_notifier.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT items.name FROM watchlist JOIN items ON watchlist.item_id = items.id WHERE watchlist.user_id = ?', (str(user_id),))
-        watchlist_items = cursor.fetchall()
-        conn.close()
+        watchlist_items = await db.run(gag_db.watchlist_names, user_id) if users.watch_count(user_id) else []
         if watchlist_items:
-            watchlist_text = "Your Watchlist:\n" + "\n".join(item[0] for item in watchlist_items)
+            watchlist_text = "Your Watchlist:\n" + "\n".join(watchlist_items)
             await query.edit_message_text(text=watchlist_text, reply_markup=get_keyboard(update))
         else:
             await query.edit_message_text(text="Your watchlist is empty.", reply_markup=get_keyboard(update))
     elif query.data == 'enable_notifications':
-        conn = sqlite3.connect('gag_notifier.db')
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET is_notified = 1 WHERE id = ?', (str(user_id),))
-        conn.commit()
-        conn.close()
+        set_notification_status(user_id, 1)
         await query.edit_message_text(text="Notifications enabled. You will now receive stock updates.", reply_markup=get_keyboard(update))
     elif query.data == 'disable_notifications':
-        conn = sqlite3.connect('gag_notifier.db')
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET is_notified = 0 WHERE id = ?', (str(user_id),))
-        conn.commit()
-        conn.close()
+        set_notification_status(user_id, 0)
         await query.edit_message_text(text="Notifications disabled. You will no longer receive stock updates.", reply_markup=get_keyboard(update))
     else:
         await query.edit_message_text(text="Unknown action.", reply_markup=get_keyboard(update))
 
+def resolve_names(item_names):
+    # Maps typed names onto catalog names; returns ({name: item_id}, [not found], [suggestions])
+    known = {}
+    not_found = []
+    suggestions = []
+    for typed in item_names:
+        name = search_index.lookup(typed)
+        if name is not None:
+            known[name] = catalog.ids[name]
+        elif typed:
+            not_found.append(typed)
+            suggestions.extend(name for name in search_index.search(typed, 3) if name not in suggestions)
+    return known, not_found, suggestions[:SUGGESTION_LIMIT]
+
+def not_found_reply(msg, not_found, suggestions, update):
+    # Appends the unknown names to msg and offers close matches as buttons
+    if not not_found:
+        return msg, get_keyboard(update)
+    msg += f"❌ Item not found: {', '.join(not_found)}\n"
+    if suggestions:
+        return msg + "Did you mean one of these?", suggestions_keyboard(suggestions)
+    return msg, get_keyboard(update)
+
+@track_handler("manual_item")
 async def manual_item_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     item_names = [name.strip() for name in update.message.text.split(',')]
     if context.user_data.get('awaiting_manual_item'):
-        conn = sqlite3.connect('gag_notifier.db')
-        cursor = conn.cursor()
         set_notification_status(user_id, 1)  # Re-enable notifications after manual item handling
-        added = []
-        already = []
-        failed = []
-        for item_name in item_names:
-            if not item_name:
-                continue
-            cursor.execute('INSERT OR IGNORE INTO items (name) VALUES (?)', (item_name,))
-            cursor.execute('SELECT id FROM items WHERE name = ?', (item_name,))
-            item_row = cursor.fetchone()
-            if item_row:
-                item_id = item_row[0]
-                cursor.execute('SELECT 1 FROM watchlist WHERE user_id = ? AND item_id = ?', (str(user_id), item_id))
-                exists = cursor.fetchone()
-                if exists:
-                    already.append(item_name)
-                else:
-                    cursor.execute('INSERT INTO watchlist (user_id, item_id) VALUES (?, ?)', (str(user_id), item_id))
-                    added.append(item_name)
-            else:
-                failed.append(item_name)
-        conn.commit()
-        conn.close()
+        known, not_found, suggestions = resolve_names(item_names)
+        added, already, failed = await db.run(gag_db.add_watch_names, user_id, list(known))
+        for item_name, item_id in added:
+            catalog.add(item_name, item_id)
+            subscriptions.subscribe(user_id, item_id)
+        users.watch_changed(user_id, len(added))
         msg = ""
         if added:
-            msg += f"✅ Added: {', '.join(added)}\n"
+            msg += f"✅ Added: {', '.join(name for name, _ in added)}\n"
         if already:
             msg += f"⚠️ Already in watchlist: {', '.join(already)}\n"
         if failed:
             msg += f"❌ Failed to add: {', '.join(failed)}\n"
-        await update.message.reply_text(msg.strip(), reply_markup=get_keyboard(update))
+        msg, reply_markup = not_found_reply(msg, not_found, suggestions, update)
+        await update.message.reply_text(msg.strip(), reply_markup=reply_markup)
         context.user_data['awaiting_manual_item'] = False
     if context.user_data.get('awaiting_remove_item'):
-        conn = sqlite3.connect('gag_notifier.db')
-        cursor = conn.cursor()
         set_notification_status(user_id, 1)  # Re-enable notifications after manual item handling
+        known, not_found, suggestions = resolve_names(item_names)
+        removed_ids = set(await db.run(gag_db.remove_watch_ids, user_id, list(known.values())))
         removed = []
         not_in_watchlist = []
-        not_found = []
-        for item_name in item_names:
-            if not item_name:
-                continue
-            cursor.execute('SELECT id FROM items WHERE name = ?', (item_name,))
-            item_row = cursor.fetchone()
-            if item_row:
-                item_id = item_row[0]
-                cursor.execute('DELETE FROM watchlist WHERE user_id = ? AND item_id = ?', (str(user_id), item_id))
-                conn.commit()
-                if cursor.rowcount > 0:
-                    removed.append(item_name)
-                else:
-                    not_in_watchlist.append(item_name)
+        for item_name, item_id in known.items():
+            if item_id in removed_ids:
+                subscriptions.unsubscribe(user_id, item_id)
+                removed.append(item_name)
             else:
-                not_found.append(item_name)
-        conn.close()
+                not_in_watchlist.append(item_name)
+        users.watch_changed(user_id, -len(removed))
         msg = ""
         if removed:
             msg += f"✅ Removed: {', '.join(removed)}\n"
         if not_in_watchlist:
             msg += f"❌ Not in watchlist: {', '.join(not_in_watchlist)}\n"
-        if not_found:
-            msg += f"❌ Item not found: {', '.join(not_found)}\n"
-        await update.message.reply_text(msg.strip(), reply_markup=get_keyboard(update))
+        msg, reply_markup = not_found_reply(msg, not_found, suggestions, update)
+        await update.message.reply_text(msg.strip(), reply_markup=reply_markup)
         context.user_data['awaiting_remove_item'] = False
 
-def update_items():
-    url = "https://growagarden.gg/api/stock"
+def parse_watchlist_document(raw):
+    # A watchlist document is a JSON array of item names, like gag_watchlist.json
+    names = json.loads(raw)
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        raise ValueError("expected a JSON array of item names")
+    return list(dict.fromkeys(name.strip() for name in names if name.strip()))
+
+@track_handler("export")
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    names = sorted(await db.run(gag_db.watchlist_names, update.effective_user.id))
+    await update.message.reply_document(
+        document=json.dumps(names, indent=2, ensure_ascii=False).encode(),
+        filename="gag_watchlist.json",
+        caption=f"{len(names)} items. Send the file back with /import as its caption to restore it.",
+    )
+
+@track_handler("import")
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Replaces the watchlist with a document sent with an /import caption, replied to with /import,
+    # or pasted after the command
+    message = update.message
+    user_id = update.effective_user.id
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json().get("lastSeen", [])
-        items_exists = [item for item in data if item.get("seen") is not None]
-        items_not_exists = [item for item in data if item.get("seen") is None]
-        conn = sqlite3.connect('gag_notifier.db')
-        cursor = conn.cursor()
-        for item in items_exists:
-            cursor.execute('INSERT OR IGNORE INTO items (name) VALUES (?)', (item["name"],))
-        for item in items_not_exists:
-            cursor.execute('DELETE FROM items WHERE name = ?', (item["name"],))
-        conn.commit()
-        conn.close()
-    except requests.RequestException as e:
+        if document is not None:
+            if document.file_size and document.file_size > MAX_IMPORT_BYTES:
+                raise ValueError("the file is larger than 64 KB")
+            file = await document.get_file()
+            raw = bytes(await file.download_as_bytearray()).decode()
+        else:
+            parts = (message.text or '').split(maxsplit=1)
+            if len(parts) < 2:
+                await message.reply_text('Send a JSON file with /import as its caption, or /import ["Item1", "Item2"].')
+                return
+            raw = parts[1]
+        names = parse_watchlist_document(raw)
+    except ValueError as e:
+        await message.reply_text(f"❌ Could not import the watchlist: {e}")
+        return
+    known, not_found, _ = resolve_names(names)  # Unknown names are skipped rather than added to the catalog
+    added, removed = await db.run(gag_db.replace_watchlist, user_id, list(known))
+    for item_id in removed:
+        subscriptions.unsubscribe(user_id, item_id)
+    for item_name, item_id in added:
+        catalog.add(item_name, item_id)
+        subscriptions.subscribe(user_id, item_id)
+    users.watch_changed(user_id, len(added) - len(removed))
+    msg = f"✅ Imported {len(known)} items ({len(added)} added, {len(removed)} removed)."
+    if not_found:
+        msg += f"\n❌ Skipped unknown items: {', '.join(not_found)}"
+    await message.reply_text(msg, reply_markup=get_keyboard(update))
+
+@track_handler("inline_query")
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Search-as-you-type; choosing a result sends the item name, which manual entry then picks up
+    query = update.inline_query.query
+    names = search_index.search(query, INLINE_RESULTS) if query.strip() else catalog.names[:INLINE_RESULTS]
+    results = [
+        InlineQueryResultArticle(
+            id=str(catalog.ids[name]),
+            title=name,
+            description=f"In stock: {current_stock[name]}" if name in current_stock else "Not in stock",
+            input_message_content=InputTextMessageContent(name),
+        )
+        for name in names
+    ]
+    await update.inline_query.answer(results, cache_time=10)
+
+async def update_items(data=None):
+    # Reuse the poll's snapshot when given one instead of fetching /api/stock again
+    try:
+        if data is None:
+            data = await http.get_json(config.stock_url)
+        last_seen = data.get("lastSeen", [])
+        # Only the SQL runs on the DB thread; the in-memory catalog is read and updated on the loop
+        added, removed = catalog.changes(last_seen)
+        if added or removed:
+            added_ids = await db.run(Catalog.write, added, removed)
+            catalog.apply(added_ids, removed)
+    except REQUEST_ERRORS as e:
         print(f"❌ Failed to update items: {e}")
         # Optionally, you can log this error to a file or database for further analysis
 
-def combine_items(items, key_qty="value"):
-    d = defaultdict(int)
-    for item in items:
-        name = item.get("name")
-        qty = item.get(key_qty, 0) or 0
-        d[name] += qty
-    return [{"name": name, "quantity": qty} for name, qty in d.items()]
-
-def seconds_until_next_5_min_offset_1():
-    now = datetime.now()
-    # Find the next minute that is a multiple of 5 plus 1
-    minute = ((now.minute // 5) + 1) * 5 + 1
-    hour = now.hour
-    day = now.day
-    month = now.month
-    year = now.year
-
-    if minute >= 60:
-        minute -= 60
-        hour += 1
-        if hour >= 24:
-            hour = 0
-            # Move to next day
-            next_t = datetime(year, month, day, hour, minute, 0, 0) + timedelta(days=1)
-        else:
-            next_t = datetime(year, month, day, hour, minute, 0, 0)
-    else:
-        next_t = datetime(year, month, day, hour, minute, 0, 0)
+async def refresh_catalog(app):
+    # Background refresh for when the periodic poll has not updated the catalog within the TTL
+    while True:
+        await asyncio.sleep(catalog.ttl)
+        if catalog.is_stale():
+            await update_items()
+
+def plan_messages(matches, check_at, changes):
+    messages = []
+    for user_id, item_names in matches.items():
+        message = delivery.plan(user_id, check_at, item_names, changes)
+        if message is not None:
+            messages.append(message)
+    return messages
+
+def write_outbox(conn, snapshots, rows):
+    # The stock history written so far is the baseline a restart diffs against; storing it with the rows
+    # means a resumed notification is never planned a second time from a stale baseline
+    history.write(conn, snapshots)
+    return outbox.write(conn, rows)
+
+async def record_outbox(messages):
+    # Written in one transaction before they are queued; if the write fails they are sent anyway
+    rows = outbox.stage(messages)
+    if rows:
+        snapshots = history.drain()
+        try:
+            await db.run(write_outbox, snapshots, rows)
+        except Exception as e:
+            history.pending[:0] = snapshots  # Keep them for the next flush
+            print(f"❌ Failed to write the outbox: {e}")
+    return messages
+
+async def flush_outbox():
+    finished = outbox.drain()
+    if finished:
+        try:
+            await db.run(outbox.delete, finished)
+        except Exception:
+            outbox.finished[:0] = finished  # Keep them for the next flush
+            raise
+
+async def outbox_writer(app):
+    # Clears delivered notifications in batches while a broadcast is still running
+    while True:
+        await asyncio.sleep(config.outbox_flush_interval)
+        try:
+            await flush_outbox()
+        except Exception as e:
+            print(f"❌ Failed to update the outbox: {e}")
+
+def merge_matches(matches, extra):
+    # Adds extra's {user_id: [item_name, ...]} to matches in place, without repeating a user's items
+    for user_id, item_names in extra.items():
+        watched = matches.get(user_id)
+        matches[user_id] = item_names if watched is None else watched + [name for name in item_names if name not in watched]
+
+async def shard_fallback(changed, failed_shards):
+    # Matches the failed shards' users from the database so they are still notified;
+    # anyone a shard reached before it failed may get the message twice
+    failed = set(failed_shards)
+    print(f"🩹 Matching shards {sorted(failed)} in-process")
+    matches = await db.run(gag_db.watchers, changed)
+    return {user_id: item_names for user_id, item_names in matches.items()
+            if shard_of(user_id, shard_pool.shards) in failed and subscriptions.is_active(user_id)}
+
+async def process_snapshot(categories, check_at, app):
+    # Diff a {category: {name: quantity}} snapshot against the previous one and notify watchers of the changes
+    async with snapshot_lock:
+        history.record(clock(), categories)
+        current, changes = engine.advance(categories)
+        # Before planning and sending: live messages render the board, and /mystock and inline results
+        # must not report an item as out of stock while its alert goes out
+        board.update(categories, clock())
+        current_stock.clear()
+        current_stock.update(current)
 
-    delta = (next_t - now).total_seconds()
-    if delta <= 0:
-        next_t += timedelta(minutes=5)
-        delta = (next_t - now).total_seconds()
-    return delta
+        # Notify users only about transitions on items they watch
+        if changes and app is not None:
+            # Resolve changed names to item ids once, then match against the in-memory index
+            changed = changed_items(changes, catalog.ids)
+            rule_matches = rules.match(categories, changes, catalog.ids, subscriptions)
+            if shard_pool is not None:
+                # Watchlists are matched in the workers; rules, and the watchers of any shard that failed, here
+                stats = await shard_pool.broadcast(check_at, changes, changed)
+                matches = await shard_fallback(changed, stats['failed_shards']) if stats['failed_shards'] else {}
+                merge_matches(matches, rule_matches)
+                if matches:
+                    local_stats = await dispatcher.broadcast(await record_outbox(plan_messages(matches, check_at, changes)))
+                    for key in ('sent', 'failed', 'blocked'):
+                        stats[key] += local_stats[key]
+            else:
+                matches = subscriptions.match(changed)
+                merge_matches(matches, rule_matches)
+                stats = await dispatcher.broadcast(await record_outbox(plan_messages(matches, check_at, changes)))
+            try:
+                await flush_outbox()
+            except Exception as e:
+                print(f"❌ Failed to update the outbox: {e}")
+            FANOUT_SECONDS.observe(stats['elapsed'])
+            print(f"📤 {len(changes)} changes, sent {stats['sent']} ({stats['failed']} failed, {stats['blocked']} blocked) "
+                  f"in {stats['elapsed']:.1f}s, {stats['rate']:.1f} msg/s, queue depth {stats['queue_depth']}")
 
 async def check_current_stock(check_at=None, app=None):
-    global previous_stock
-    url = "https://growagarden.gg/api/stock"
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-
-        current = {}
-        for cat in ("gearStock", "seedsStock", "cosmeticsStock", "eggStock", "merchantsStock",
-                    "easterStock", "nightStock", "eventStock"):
-            items = combine_items(data.get(cat, []))
-            for it in items:
-                current[it["name"]] = it["quantity"]
-
-        in_stock_items = [name for name, qty in current.items() if qty > 0]
-
-        # Notify users
-        if in_stock_items and app is not None:
-            conn = sqlite3.connect('gag_notifier.db')
-            cursor = conn.cursor()
-            # Get all users who want notifications
-            cursor.execute('SELECT id FROM users WHERE is_notified = 1')
-            user_ids = [row[0] for row in cursor.fetchall()]
-            for user_id in user_ids:
-                # Get user's watchlist items that are in stock
-                cursor.execute('''
-                    SELECT items.name FROM watchlist
-                    JOIN items ON watchlist.item_id = items.id
-                    WHERE watchlist.user_id = ? AND items.name IN ({})
-                '''.format(','.join('?' * len(in_stock_items))),
-                [str(user_id)] + in_stock_items)
-                watched_in_stock = [row[0] for row in cursor.fetchall()]
-                if watched_in_stock:
-                    message = f"📦 Stock check at {check_at}:\n"
-                    for item_name in watched_in_stock:
-                        message += f"*{item_name}*: {current[item_name]}\n"
-                    await app.bot.send_message(
-                        chat_id=user_id,
-                        text=message,
-                        parse_mode='Markdown',
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("Add Item to Watchlist", callback_data='btn_add')],
-                            [InlineKeyboardButton("Remove Item from Watchlist", callback_data='btn_remove')],
-                            [InlineKeyboardButton("View Watchlist", callback_data='view_watchlist')],
-                            [InlineKeyboardButton("Disable Notifications", callback_data='disable_notifications')]
-                        ])
-                    )
-                else:
-                    print(f"🗑️ No watched items in stock for user {user_id} at {check_at}")
-                    await app.bot.send_message(
-                        chat_id=user_id,
-                        text=f"No watched items in stock at {check_at}.",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("Add Item to Watchlist", callback_data='btn_add')],
-                            [InlineKeyboardButton("Remove Item from Watchlist", callback_data='btn_remove')],
-                            [InlineKeyboardButton("View Watchlist", callback_data='view_watchlist')],
-                            [InlineKeyboardButton("Disable Notifications", callback_data='disable_notifications')]
-                        ])
-                    )
-            conn.close()
-
-        previous_stock = current.copy()
-        current_stock.update(current)
+        data, categories = await engine.poll()
+        if categories is None:
+            board.touch(clock())
+            print(f"♻️ Stock unchanged, skipping ({engine.fetcher.stats})")
+            return data
+        await update_items(data)
+        await process_snapshot(categories, check_at, app)
+        return data
 
     except Exception as e:
+        engine.fetcher.reset()  # Reprocess the next snapshot in full rather than skipping it as unchanged
         if isinstance(e, error.Forbidden):
             pass  # Do nothing, just ignore
         else:
@@ -472,26 +484,353 @@ async def check_current_stock(check_at=None, app=None):
                     print(f"❌ Failed to send error message: {send_err}")
 
 async def periodic_stock_check(app):
+    async def check(check_at):
+        with profiler.cycle():
+            return await check_current_stock(check_at=check_at, app=app)
+
     try:
-        while True:
-            now = datetime.now().strftime("%H:%M:%S")
-            print(f"⏰ Check at {now}")
-            await check_current_stock(check_at=now, app=app)
-            wait = seconds_until_next_5_min_offset_1()
-            print(f"🕒 Sleep for {int(wait)} s")
-            await asyncio.sleep(wait)
+        # Polling pauses while the realtime feed is delivering changes
+        await engine.run(check, paused=lambda: feed is not None and feed.live, pause_interval=FEED_POLL_CHECK)
     except KeyboardInterrupt:
         print("🔴 Stopping the notifier.")
 
-async def on_startup(app):
-    app.create_task(periodic_stock_check(app))
+def on_sent(chat_id, tag, message):
+    # A new live message was sent: remember it for later edits and pin it
+    if tag == LIVE and users.live_message(chat_id) != message.message_id:
+        users.set_live_message(chat_id, message.message_id)
+        dispatcher.submit(chat_id, method="pin_chat_message", message_id=message.message_id, disable_notification=True)
+
+async def send_digests(app):
+    while True:
+        await asyncio.sleep(DIGEST_CHECK_INTERVAL)
+        for chat_id, kwargs in await record_outbox(delivery.due()):
+            dispatcher.submit(chat_id, **kwargs)
+
+@track_handler("delivery")
+async def delivery_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if not context.args or context.args[0].lower() not in DELIVERY_MODES:
+        await update.message.reply_text(
+            f"Delivery is '{users.delivery_mode(user_id)}'. Use /delivery message for a new message per update, "
+            "or /delivery live for one pinned message that is edited in place."
+        )
+        return
+    mode = context.args[0].lower()
+    users.set_delivery(user_id, mode)
+    await update.message.reply_text(f"✅ Delivery set to '{mode}'.", reply_markup=get_keyboard(update))
+
+@track_handler("digest")
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    try:
+        minutes = int(context.args[0])
+        if not 0 <= minutes <= MAX_DIGEST_MINUTES:
+            raise ValueError
+    except (IndexError, ValueError):
+        current = users.digest_minutes(user_id)
+        await update.message.reply_text(
+            (f"Digest window is {current} min." if current else "Digest is off.")
+            + f" Use /digest <minutes> (1-{MAX_DIGEST_MINUTES}) to merge updates, or /digest 0 to turn it off."
+        )
+        return
+    users.set_digest(user_id, minutes)
+    text = f"✅ Updates are merged into one message every {minutes} min." if minutes else "✅ Digest turned off."
+    await update.message.reply_text(text, reply_markup=get_keyboard(update))
 
-app = ApplicationBuilder().token(TOKEN).build()
+RULE_USAGE = ("Use /rule <rule> to add one, e.g. /rule Seeds: Beanstalk >= 2, /rule eggs: any or /rule merchants: any.\n"
+              "/rule del <id> removes a rule.")
 
-app.add_handler(CommandHandler("start", start))
-app.add_handler(CallbackQueryHandler(button_callback))
-app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, manual_item_handler))
+@track_handler("rule")
+async def rule_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /rule lists your rules, /rule <rule> adds one, /rule del <id> removes one
+    user_id = update.effective_user.id
+    users.register(user_id, update.effective_user.username)
+    if not context.args:
+        own = await db.run(gag_db.user_rules, user_id)
+        lines = [f"{rule_id}. {describe_rule(category, name, min_quantity)}" for rule_id, category, name, min_quantity in own]
+        text = ("📋 Your rules:\n" + "\n".join(lines)) if lines else "You have no rules."
+        await update.message.reply_text(f"{text}\n\n{RULE_USAGE}")
+        return
+    if context.args[0].lower() in ("del", "delete", "remove"):
+        try:
+            rule_id = int(context.args[1])
+        except (IndexError, ValueError):
+            await update.message.reply_text("Usage: /rule del <id>")
+            return
+        if await db.run(gag_db.remove_rule, user_id, rule_id):
+            rules.remove(rule_id)
+            await update.message.reply_text(f"🗑️ Removed rule {rule_id}.", reply_markup=get_keyboard(update))
+        else:
+            await update.message.reply_text(f"❌ You have no rule {rule_id}.")
+        return
+    try:
+        category, name, min_quantity = parse_rule(" ".join(context.args), search_index.lookup)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}.\n\n{RULE_USAGE}")
+        return
+    if len(await db.run(gag_db.user_rules, user_id)) >= MAX_RULES:
+        await update.message.reply_text(f"❌ You already have {MAX_RULES} rules; remove one with /rule del <id> first.")
+        return
+    item_id = catalog.ids.get(name) if name else None
+    rule_id = await db.run(gag_db.add_rule, user_id, category, item_id, min_quantity)
+    rules.add(rule_id, user_id, category, item_id, min_quantity)
+    await update.message.reply_text(f"✅ Rule {rule_id} added: {describe_rule(category, name, min_quantity)}",
+                                    reply_markup=get_keyboard(update))
+
+async def flush_users():
+    rows = users.drain()
+    if rows:
+        try:
+            await db.run(gag_db.upsert_users, rows)
+        except Exception:
+            users.restore(rows)
+            raise
+
+async def user_writer(app):
+    # Coalesces flag and username changes into one upsert per interval
+    while True:
+        await asyncio.sleep(config.user_flush_interval)
+        try:
+            await flush_users()
+        except Exception as e:
+            print(f"❌ Failed to write user state: {e}")
+
+async def flush_history():
+    pending = history.drain()
+    if pending:
+        try:
+            await db.run(history.write, pending)
+        except Exception:
+            history.pending[:0] = pending  # Keep them for the next flush
+            raise
+
+async def history_writer(app):
+    # Batches snapshot inserts; prunes old partitions about once a day
+    last_prune = 0.0
+    while True:
+        await asyncio.sleep(config.history_flush_interval)
+        try:
+            await flush_history()
+            if config.history_months and time.time() - last_prune > 86400:
+                last_prune = time.time()
+                dropped = await db.run(history.prune, config.history_months)
+                if dropped:
+                    print(f"🗄️ Dropped history partitions {', '.join(dropped)}")
+        except Exception as e:
+            print(f"❌ Failed to write stock history: {e}")
+
+@track_handler("stats")
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    name = " ".join(context.args)
+    if not name:
+        await update.message.reply_text("Usage: /stats <item name>")
+        return
+    await flush_history()
+    stats = await db.run(history.item_stats, name)
+    if stats is None:
+        await update.message.reply_text(f"❌ No stock history for '{name}'.")
+    else:
+        await update.message.reply_text(format_stats(stats), parse_mode='Markdown')
+
+def stock_age():
+    if feed is not None and feed.live:
+        return "🟢 Live"
+    return f"🕒 Checked {format_duration(clock() - board.checked_at)} ago"
+
+@track_handler("stock")
+async def stock_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Served from the in-memory snapshot; /stock <category> shows matching categories only
+    if board.updated_at is None:
+        await update.message.reply_text("⏳ No stock snapshot yet, try again in a moment.")
+        return
+    categories = board.find_categories(" ".join(context.args)) if context.args else None
+    if context.args and not categories:
+        await update.message.reply_text(f"❌ No category matching '{' '.join(context.args)}' is in stock.")
+        return
+    await update.message.reply_text(f"{stock_age()}\n\n{board.render(categories)}", parse_mode='Markdown')
+
+@track_handler("mystock")
+async def mystock_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if board.updated_at is None:
+        await update.message.reply_text("⏳ No stock snapshot yet, try again in a moment.")
+        return
+    user_id = update.effective_user.id
+    in_stock = [catalog.ids[name] for name in current_stock if name in catalog.ids]
+    if shard_pool is not None:
+        # Watchlists live in the shard workers; a primary-key lookup limited to what is in stock
+        watched = await db.run(gag_db.watched_ids, user_id, in_stock)
+    else:
+        watched = subscriptions.watched_among(user_id, in_stock)
+    if not watched:
+        text = "None of your watched items are in stock right now." if users.watch_count(user_id) else "Your watchlist is empty."
+        await update.message.reply_text(f"{stock_age()}\n\n{text}", reply_markup=get_keyboard(update))
+        return
+    await update.message.reply_text(f"{stock_age()}\n\n{board.render_for(catalog.ids, watched)}",
+                                    parse_mode='Markdown', reply_markup=get_keyboard(update))
+
+async def on_feed_change(snapshot):
+    try:
+        with profiler.cycle():
+            await process_snapshot(feed.state, check_time(clock), app)
+    except Exception as e:
+        print(f"❌ Failed to process feed update: {e}")
+
+async def start_services(app):
+    global dispatcher, shard_pool
+    await http.start()
+    dispatcher = Dispatcher(app.bot, on_blocked=mark_blocked, on_sent=on_sent, on_done=outbox.done)
+    dispatcher.start()
+    QUEUE_DEPTH.set_function(dispatcher.queue.qsize)
+    # Notifications a previous run matched but did not finish sending
+    messages, dropped = await db.run(outbox.resume, config.outbox_max_age)
+    if messages or dropped:
+        print(f"📮 Resuming {len(messages)} undelivered notifications, dropped {dropped} stale ones")
+    for chat_id, kwargs in messages:
+        dispatcher.submit(chat_id, **kwargs)
+    if config.notify_shards:
+        bot_options = {"token": config.token, **({"base_url": config.base_url} if config.base_url else {})}
+        shard_pool = await ShardPool(config.notify_shards, gag_db.DB_PATH, bot_options, on_blocked=mark_blocked,
+                                     before_restart=flush_users).start()
+        subscriptions.pool = shard_pool
 
-app.post_init = on_startup  # Start background task after bot starts
+async def on_startup(app):
+    global feed, metrics_server
+    await start_services(app)
+    if config.metrics_port:
+        from gag_metrics import MetricsServer
+        metrics_server = await MetricsServer(profiler, int(config.metrics_port)).start()
+    if config.stock_ws_url:
+        from gag_feed import StockFeed
+        feed = StockFeed(http, config.stock_ws_url, on_feed_change)
+        app.create_task(feed.run())
+    app.create_task(periodic_stock_check(app))
+    app.create_task(refresh_catalog(app))
+    app.create_task(history_writer(app))
+    app.create_task(user_writer(app))
+    app.create_task(outbox_writer(app))
+    app.create_task(send_digests(app))
+
+async def on_shutdown(app):
+    if metrics_server is not None:
+        await metrics_server.stop()
+    if shard_pool is not None:
+        await shard_pool.stop()
+    await dispatcher.stop()
+    await http.close()
+    await flush_outbox()
+    await flush_users()
+    await flush_history()
+    db.close()
+
+def build_app():
+    # Telegram calls go through python-telegram-bot's own pooled client; size it like ours
+    builder = (
+        ApplicationBuilder()
+        .token(config.token)
+        .connection_pool_size(http.pool_size)
+        .read_timeout(http.timeout)
+    )
+    if config.base_url:
+        builder.base_url(config.base_url)
+    application = builder.build()
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("stock", stock_command))
+    application.add_handler(CommandHandler("mystock", mystock_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("delivery", delivery_command))
+    application.add_handler(CommandHandler("digest", digest_command))
+    application.add_handler(CommandHandler("rule", rule_command))
+    application.add_handler(CommandHandler("import", import_command))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/import\b'), import_command))
+    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(InlineQueryHandler(inline_query))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, manual_item_handler))
+
+    application.post_init = on_startup  # Start background task after bot starts
+    application.post_shutdown = on_shutdown
+    return application
+
+def setup(args=None, time_source=time.time, sleep=asyncio.sleep):
+    # Everything with side effects (reading .env, opening and migrating the DB, loading the indexes) happens here.
+    # time_source and sleep replace the wall clock, see gag_replay.py
+    global config, http, db, engine, subscriptions, catalog, catalog_pages, search_index, users, delivery, outbox, profiler, app, clock
+    load_dotenv()
+    clock = time_source
+    config = Config(args)
+    http = HttpClient()
+    db = Database(gag_db.DB_PATH).open()  # Applies pending schema migrations
+    engine = StockEngine(http, config.stock_url, clock=clock, sleep=sleep)
+    subscriptions = ShardedIndex() if config.notify_shards else SubscriptionIndex()
+    catalog = Catalog(ttl=config.catalog_ttl)
+    catalog_pages = CatalogPages(catalog, ITEMS_PER_PAGE)
+    search_index = SearchIndex(catalog)
+    profiler = SamplingProfiler()
+
+    subscriptions.load(db.conn)
+    users = UserCache(subscriptions)
+    users.load(db.conn)
+    delivery = Delivery(users, board, catalog, subscriptions, clock=clock)
+    outbox = Outbox(clock=clock)
+    outbox.load(db.conn)
+    catalog.load(db.conn)
+    history.load(db.conn)
+    rules.load(db.conn)
+    engine.previous = dict(history.latest)  # Diff against the last recorded snapshot, not an empty one
+    app = build_app()
+    return app
+
+async def run_once():
+    # One poll and its notifications, without polling for updates; for cron or testing
+    await app.initialize()
+    await start_services(app)
+    try:
+        await check_current_stock(check_at=check_time(clock), app=app)
+        await dispatcher.queue.join()  # Including any resumed from the outbox
+    finally:
+        await app.post_shutdown(app)
+        await app.shutdown()
+
+async def run_webhook():
+    from gag_webhook import WebhookServer
+
+    if not config.webhook_secret:
+        # Telegram echoes the secret in every update; without one anybody could post fake updates
+        config.webhook_secret = secrets.token_urlsafe(32)
+        print("🔐 WEBHOOK_SECRET is not set, using a random one for this run")
+    server = WebhookServer(app, path=urlparse(config.webhook_url).path or "/telegram", secret_token=config.webhook_secret,
+                           host=config.webhook_host, port=config.webhook_port)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    try:
+        await server.start()
+        await app.bot.set_webhook(config.webhook_url, secret_token=config.webhook_secret, allowed_updates=Update.ALL_TYPES,
+                                  max_connections=min(server.max_concurrency, 100))
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        await app.stop()
+        await app.post_shutdown(app)
+        await app.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grow a Garden stock notifier bot.")
+    parser.add_argument("--once", action="store_true", help="check the stock once, send the notifications and exit")
+    parser.add_argument("--webhook-url", help="receive updates on this public HTTPS URL (overrides WEBHOOK_URL)")
+    parser.add_argument("--shards", type=int, help="worker processes for matching and sending (overrides NOTIFY_SHARDS)")
+    parser.add_argument("--metrics-port", help="serve /metrics on this localhost port (overrides METRICS_PORT)")
+    setup(parser.parse_args(argv))
+    try:
+        if config.once:
+            asyncio.run(run_once())
+        elif config.webhook_url:
+            asyncio.run(run_webhook())
+        else:
+            app.run_polling()
+    except KeyboardInterrupt:
+        print("🔴 Stopping the notifier.")
 
-app.run_polling()
\ No newline at end of file
+# Guarded so shard workers, which are spawned and re-import this module, do not start the bot
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import json
+import time
+
+from telegram import InlineKeyboardMarkup
+
+
+class Outbox:
+    """Notifications between matching and delivery, kept in the outbox table so a restart can finish them.
+
+    stage() numbers a batch of (chat_id, kwargs) messages and tags each with its row id as the dispatcher
+    `ref`; write() inserts the batch in one transaction before it is queued. done() collects the refs the
+    dispatcher has finished and delete() removes them in one batch per flush, so a crash re-sends at most
+    the messages finished since the last flush. Row ids are assigned here, the main process being the only
+    writer, which keeps the insert a plain executemany.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.next_id = 1
+        self.finished = []
+
+    def load(self, conn):
+        self.next_id = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM outbox').fetchone()[0]
+
+    def stage(self, messages):
+        # Returns the rows for write(); the messages' kwargs gain their `ref`
+        created_at = self.clock()
+        markups = {}  # Messages share a few keyboard objects; encode each once and splice it in
+        rows = []
+        for chat_id, kwargs in messages:
+            markup = kwargs.get("reply_markup")
+            if markup is None:
+                payload = json.dumps(kwargs)
+            else:
+                if id(markup) not in markups:
+                    markups[id(markup)] = json.dumps(markup.to_dict())
+                fields = json.dumps({key: value for key, value in kwargs.items() if key != "reply_markup"})
+                payload = f'{fields[:-1]}{", " if len(kwargs) > 1 else ""}"reply_markup": {markups[id(markup)]}}}'
+            rows.append((self.next_id, created_at, int(chat_id), payload))
+            kwargs["ref"] = self.next_id
+            self.next_id += 1
+        return rows
+
+    def write(self, conn, rows):
+        conn.executemany('INSERT INTO outbox (id, created_at, chat_id, payload) VALUES (?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def done(self, ref):
+        self.finished.append(ref)
+
+    def drain(self):
+        finished, self.finished = self.finished, []
+        return finished
+
+    def delete(self, conn, refs):
+        conn.executemany('DELETE FROM outbox WHERE id = ?', [(ref,) for ref in refs])
+        return len(refs)
+
+    def resume(self, conn, max_age):
+        # Drops rows older than max_age seconds; returns (the rest as messages, oldest first, and how many were dropped)
+        dropped = conn.execute('DELETE FROM outbox WHERE created_at < ?', (self.clock() - max_age,)).rowcount
+        messages = []
+        for ref, chat_id, payload in conn.execute('SELECT id, chat_id, payload FROM outbox ORDER BY id'):
+            kwargs = json.loads(payload)
+            if "reply_markup" in kwargs:
+                kwargs["reply_markup"] = InlineKeyboardMarkup.de_json(kwargs["reply_markup"], None)
+            kwargs["ref"] = ref
+            messages.append((chat_id, kwargs))
+        return messages, dropped
@@ -0,0 +1,237 @@
+"""Replay a recorded (or synthetic) day of stock through gag_notifier_v2's poll loop, faster than real time.
+
+    python gag_replay.py --hours 24 --users 50                  # synthetic restocks every 5 minutes
+    python gag_replay.py --recording stock.jsonl --speed 200    # payloads captured with --capture
+    python gag_replay.py --capture stock.jsonl --hours 2         # record the live API for later replays
+
+periodic_stock_check runs unchanged against a local stub of /api/stock and a fake Bot API, on a
+virtual clock: the poll loop's sleeps skip ahead (taking 1/speed of their real duration) while
+fetching, matching and sending run at real speed. Each stub payload goes live at its recorded time,
+so the polls, and the restocks they see, are the same on every run. Every delivered message is
+attributed to the stock change it reports, giving change-to-delivery latency per user; deliveries
+are also checked against the users whose watched items actually changed.
+"""
+import argparse
+import asyncio
+import bisect
+import contextlib
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import gag_db
+import gag_notifier_v2
+from gag_bench import FIRST_USER_ID, catalog_names, populate
+from gag_diff import diff_stock
+from gag_fakes import FakeTelegramServer, StockStubServer
+from gag_http import HttpClient
+from gag_stock import STOCK_CATEGORIES, parse_stock
+from gag_webhook import percentiles
+
+HERE = Path(__file__).resolve().parent
+RESTOCK_PERIOD = 300
+REPLAY_START = 1752969600  # 2025-07-20 00:00 UTC; fixed so synthetic runs are identical
+
+
+class VirtualClock:
+    """Runs at real speed while there is work and skips ahead through sleeps.
+
+    sleep(seconds) takes seconds / speed of real time (none at speed 0) and leaves the clock exactly
+    `seconds` later, so scheduling decisions do not depend on how fast the machine is.
+    """
+
+    def __init__(self, start, speed=1000.0):
+        self.now = start
+        self.mark = time.monotonic()
+        self.speed = speed
+
+    def time(self):
+        return self.now + time.monotonic() - self.mark
+
+    async def sleep(self, seconds):
+        seconds = max(seconds, 0)
+        target = self.time() + seconds
+        await asyncio.sleep(seconds / self.speed if self.speed else 0)
+        self.now, self.mark = max(target, self.time()), time.monotonic()
+
+
+def iso(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def synthetic_day(base, hours, items, seed, offset=10):
+    # One payload per restock: new seeds and gear every 5 minutes, eggs every 30, the rest as in `base`
+    rng = random.Random(seed)
+    names = catalog_names(base)
+    pool = rng.sample(names, min(items, len(names)))
+    payloads, schedule = [], []
+    eggs = base.get("eggStock", [])
+    for i in range(int(hours * 3600 // RESTOCK_PERIOD)):
+        at = REPLAY_START + i * RESTOCK_PERIOD + offset
+        payload = {cat: list(base.get(cat, [])) for cat in STOCK_CATEGORIES}
+        payload["seedsStock"] = [{"name": name, "value": rng.randint(1, 20)} for name in rng.sample(pool, rng.randint(4, 8))]
+        payload["gearStock"] = [{"name": name, "value": rng.randint(1, 5)} for name in rng.sample(pool, rng.randint(3, 6))]
+        if i % 6 == 0:
+            eggs = [{"name": name, "value": 1} for name in rng.sample(pool, 3)]
+        payload["eggStock"] = eggs
+        payload["lastSeen"] = [{"name": item["name"], "seen": iso(at)}
+                               for cat in ("seedsStock", "gearStock") for item in payload[cat]]
+        payloads.append(payload)
+        schedule.append(at)
+    return payloads, schedule, pool
+
+
+def load_recording(path):
+    # JSON lines of {"at": epoch seconds, "stock": /api/stock payload}, as written by --capture
+    entries = [json.loads(line) for line in Path(path).read_text().splitlines() if line.strip()]
+    entries.sort(key=lambda entry: entry["at"])
+    payloads = [entry["stock"] for entry in entries]
+    names = sorted({name for payload in payloads for name in parse_stock(payload)})
+    return payloads, [entry["at"] for entry in entries], names
+
+
+async def capture(args):
+    # Appends every distinct payload of the live API with the time it was first seen
+    http = await HttpClient().start()
+    last = None
+    deadline = time.time() + args.hours * 3600
+    try:
+        with open(args.capture, "a") as out:
+            while time.time() < deadline:
+                data = await http.get_json(os.getenv("STOCK_URL") or gag_notifier_v2.STOCK_URL)
+                stock = parse_stock(data)
+                if stock != last:
+                    last = stock
+                    out.write(json.dumps({"at": round(time.time(), 3), "stock": data}) + "\n")
+                    out.flush()
+                    print(f"📼 {datetime.now().strftime('%H:%M:%S')} recorded {len(stock)} items")
+                await asyncio.sleep(args.interval)
+    finally:
+        await http.close()
+
+
+def expected_deliveries(payloads, watchlists):
+    # For each payload, the users with at least one watched item that changed since the previous one
+    expected = []
+    previous = {}
+    for payload in payloads:
+        current = parse_stock(payload)
+        changed = set(diff_stock(previous, current))
+        previous = current
+        expected.append({user_id for user_id, names in watchlists.items() if names & changed})
+    return expected
+
+
+async def replay(args):
+    base = json.loads(Path(args.payload).read_text())
+    if args.recording:
+        payloads, schedule, names = load_recording(args.recording)
+    else:
+        payloads, schedule, names = synthetic_day(base, args.hours, args.items, args.seed)
+    start = schedule[0] - RESTOCK_PERIOD / 2
+    schedule[0] = start  # The first payload is the stock already up when the replay starts
+    end = schedule[-1] + RESTOCK_PERIOD
+    clock = VirtualClock(start, args.speed)
+
+    deliveries = []  # (user_id, virtual time)
+
+    def on_message(method, chat_id, params):
+        deliveries.append((int(chat_id), clock.time()))
+
+    stock_server = await StockStubServer(payloads, schedule=schedule, clock=clock.time).start()
+    telegram_server = await FakeTelegramServer(on_message=on_message).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        gag_db.DB_PATH = os.path.join(tmp, "replay.db")
+        db = gag_db.Database(gag_db.DB_PATH).open()
+        populate(db, args.users, args.watch, names, args.seed)
+        watchlists = {}
+        for user_id, name in db.conn.execute('SELECT w.user_id, i.name FROM watchlist w JOIN items i ON i.id = w.item_id'):
+            watchlists.setdefault(user_id, set()).add(name)
+        db.close()
+
+        os.environ.update({"TELEGRAM_BOT_TOKEN": "123456:replay", "STOCK_URL": stock_server.url,
+                           "TELEGRAM_BASE_URL": telegram_server.base_url, "NOTIFY_SHARDS": "0"})
+        if args.rate:
+            os.environ["DISPATCH_RATE"] = str(args.rate)
+        started = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull):
+            app = gag_notifier_v2.setup(time_source=clock.time, sleep=clock.sleep)
+            await app.initialize()
+            await gag_notifier_v2.start_services(app)
+            poller = asyncio.create_task(gag_notifier_v2.periodic_stock_check(app))
+            try:
+                while clock.time() < end and not poller.done():
+                    await asyncio.sleep(0.05)
+            finally:
+                poller.cancel()
+                await asyncio.gather(poller, return_exceptions=True)
+                await app.post_shutdown(app)
+                await app.shutdown()
+        elapsed = time.perf_counter() - started
+    await telegram_server.stop()
+    await stock_server.stop()
+
+    expected = expected_deliveries(payloads, watchlists)
+    delivered = [set() for _ in payloads]
+    latencies = {}
+    for user_id, at in deliveries:
+        index = max(bisect.bisect_right(schedule, at) - 1, 0)  # The latest change before the delivery
+        delivered[index].add(user_id)
+        latencies.setdefault(user_id, []).append(at - schedule[index])
+    all_latencies = [latency for samples in latencies.values() for latency in samples]
+    per_user = {
+        user_id: {"messages": len(samples), **{key: round(value, 3) for key, value in percentiles(samples, (50, 95)).items()},
+                  "max": round(max(samples), 3)}
+        for user_id, samples in sorted(latencies.items())
+    }
+    return {
+        "restocks": len(payloads),
+        "users": args.users,
+        "virtual_hours": round((end - start) / 3600, 2),
+        "real_seconds": round(elapsed, 1),
+        "speedup": round((end - start) / elapsed, 1),
+        "stub_requests": stock_server.requests,
+        "messages": len(deliveries),
+        "expected": sum(len(users) for users in expected),
+        "missing": sum(len(want - got) for want, got in zip(expected, delivered)),
+        "unexpected": sum(len(got - want) for want, got in zip(expected, delivered)),
+        "latency_seconds": {key: round(value, 3) for key, value in
+                            {**percentiles(all_latencies, (50, 95, 99)), "max": max(all_latencies, default=0.0)}.items()},
+        "per_user": per_user,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recording", help="JSON lines of {at, stock} to replay instead of synthetic restocks")
+    parser.add_argument("--capture", help="record the live API into this file instead of replaying")
+    parser.add_argument("--interval", type=float, default=15, help="seconds between polls while capturing")
+    parser.add_argument("--hours", type=float, default=24, help="synthetic restocks to generate, or capture duration")
+    parser.add_argument("--speed", type=float, default=1000, help="virtual seconds per real second while idle (0 = no waiting)")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--watch", type=int, default=3, help="watchlist size per user")
+    parser.add_argument("--items", type=int, default=120, help="distinct items the synthetic stock rotates through")
+    parser.add_argument("--rate", type=float, help="dispatch rate in messages/s (default: DISPATCH_RATE)")
+    parser.add_argument("--payload", default=str(HERE / "example_stock.json"), help="template for synthetic payloads")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="replay_results.json")
+    parser.add_argument("--verbose", action="store_true", help="show the notifier's own log")
+    args = parser.parse_args()
+
+    if args.capture:
+        asyncio.run(capture(args))
+        return
+    report = asyncio.run(replay(args))
+    Path(args.out).write_text(json.dumps(report, indent=2))
+    slowest = sorted(report["per_user"].items(), key=lambda item: item[1]["max"], reverse=True)[:5]
+    print(json.dumps({key: value for key, value in report.items() if key != "per_user"}, indent=2))
+    print("Slowest users: " + ", ".join(f"{int(user_id) - FIRST_USER_ID} ({stats['max']} s)" for user_id, stats in slowest))
+    print(f"✅ Wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
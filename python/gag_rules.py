@@ -0,0 +1,100 @@
+import bisect
+import re
+from collections import defaultdict
+
+from gag_stock import category_title, resolve_category
+
+MAX_RULES = 20
+ANY_ITEM = ('', '*', 'any')
+RULE_PATTERN = re.compile(r'^(?:(?P<category>[^:]+):)?\s*(?P<item>.*?)\s*(?:(?:>=|≥)\s*(?P<min>\d+))?$')
+
+
+def parse_rule(text, lookup):
+    # "[category:] [item | any] [>= N]" -> (category, item name, min quantity); raises ValueError
+    match = RULE_PATTERN.match(text.strip())
+    if match is None:
+        raise ValueError("expected [category:] item [>= N]")
+    category = None
+    if match['category'] is not None:
+        category = resolve_category(match['category'])
+        if category is None:
+            raise ValueError(f"unknown category '{match['category'].strip()}'")
+    name = None
+    if match['item'].casefold() not in ANY_ITEM:
+        name = lookup(match['item'])
+        if name is None:
+            raise ValueError(f"unknown item '{match['item']}'")
+    elif category is None:
+        raise ValueError("a rule needs an item, a category or both")
+    min_quantity = int(match['min']) if match['min'] else 1
+    return category, name, max(min_quantity, 1)
+
+
+def describe_rule(category, name, min_quantity):
+    text = f"{category_title(category)}: " if category else ""
+    text += name or "any item"
+    if min_quantity > 1:
+        text += f" ≥ {min_quantity}"
+    return text
+
+
+class RuleMatcher:
+    """Users' stock rules, compiled into shared per-item and per-category threshold groups.
+
+    A rule is (user, category or None, item id or None, min quantity). Rules are grouped by the
+    (category, item) key they test, each group sorted by threshold, so a snapshot is matched in one
+    pass over the changed items: the users of a group whose threshold the quantity meets are a
+    prefix found by bisect, and users whose rules do not apply are never visited.
+    """
+
+    def __init__(self):
+        self.rules = {}  # rule id -> (user_id, category, item_id, min_quantity)
+        self.groups = {}  # (category or None, item_id or None) -> ([thresholds], [user_ids])
+        self.dirty = False
+
+    def load(self, conn):
+        self.rules = {rule_id: (user_id, category, item_id, min_quantity) for rule_id, user_id, category, item_id, min_quantity
+                      in conn.execute('SELECT id, user_id, category, item_id, min_quantity FROM rules')}
+        self.dirty = True
+
+    def add(self, rule_id, user_id, category, item_id, min_quantity):
+        self.rules[rule_id] = (int(user_id), category, item_id, min_quantity)
+        self.dirty = True
+
+    def remove(self, rule_id):
+        if self.rules.pop(rule_id, None) is not None:
+            self.dirty = True
+
+    def compile(self):
+        pending = defaultdict(list)
+        for user_id, category, item_id, min_quantity in self.rules.values():
+            pending[(category, item_id)].append((min_quantity, user_id))
+        groups = {}
+        for key, entries in pending.items():
+            entries.sort()
+            groups[key] = ([threshold for threshold, _ in entries], [user_id for _, user_id in entries])
+        self.groups = groups
+        self.dirty = False
+
+    def match(self, categories, changes, item_ids, index):
+        # {user_id: [item name, ...]} for changed items that now satisfy one of the user's rules;
+        # users who turned notifications off or blocked the bot are skipped, as in SubscriptionIndex.match
+        if self.dirty:
+            self.compile()
+        if not self.groups:
+            return {}
+        matches = defaultdict(dict)
+        for category, stock in categories.items():
+            for name, quantity in stock.items():
+                if name not in changes:
+                    continue
+                item_id = item_ids.get(name)
+                for key in ((category, item_id), (None, item_id), (category, None)):
+                    group = self.groups.get(key)
+                    if group is None or (key[1] is None and key[0] is None):
+                        continue
+                    thresholds, user_ids = group
+                    for user_id in user_ids[:bisect.bisect_right(thresholds, quantity)]:
+                        matches[user_id][name] = None
+        return {user_id: list(names) for user_id, names in matches.items()
+                if index.is_active(user_id)}
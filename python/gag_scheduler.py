@@ -0,0 +1,63 @@
+import os
+import statistics
+import time
+from collections import deque
+from datetime import datetime
+
+
+def _parse_seen(value):
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
+class RestockScheduler:
+    """Sleeps until just before each expected restock, then polls in a tight burst until the stock changes.
+
+    The expected restock moment is a boundary (every `period` seconds) plus an offset learned from
+    the upstream lastSeen timestamps.
+    """
+
+    def __init__(self, period=300, offset=None, burst_interval=None, burst_window=None, lead=2.0, clock=time.time):
+        self.period = period
+        self.offset = offset if offset is not None else float(os.getenv("POLL_OFFSET", "10"))
+        self.burst_interval = burst_interval if burst_interval is not None else float(os.getenv("POLL_BURST_INTERVAL", "5"))
+        self.burst_window = burst_window if burst_window is not None else float(os.getenv("POLL_BURST_WINDOW", "90"))
+        self.lead = lead
+        self.clock = clock
+        self.samples = deque(maxlen=12)
+        self.last_fingerprint = None
+        self.burst_until = 0.0
+
+    def observe(self, data, fingerprint):
+        # Record a poll result; returns True when the stock differs from the previous poll.
+        # fingerprint is the one StockFetcher already computed for data, not hashed again here
+        if data is None:
+            return False
+        changed = fingerprint != self.last_fingerprint
+        self.last_fingerprint = fingerprint
+        if changed:
+            self._learn(data.get("lastSeen", []))
+            self.burst_until = 0.0  # This cycle's restock is in; idle until the next boundary
+        return changed
+
+    def _learn(self, last_seen):
+        now = self.clock()
+        stamps = [ts for ts in (_parse_seen(item.get("seen")) for item in last_seen) if ts is not None]
+        if not stamps:
+            return
+        latest = max(stamps)
+        if 0 <= now - latest < self.period:
+            self.samples.append(latest % self.period)
+            self.offset = statistics.median(self.samples)
+
+    def next_delay(self):
+        now = self.clock()
+        if now < self.burst_until:
+            return self.burst_interval
+        target = now - now % self.period + self.offset - self.lead
+        if target <= now:
+            target += self.period
+        self.burst_until = target + self.burst_window
+        return target - now
@@ -0,0 +1,115 @@
+import bisect
+from collections import defaultdict
+
+
+def fold(text):
+    return " ".join(text.casefold().split())
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit=None):
+    # Levenshtein distance; stops early and returns limit + 1 once every path exceeds `limit`
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class SearchIndex:
+    """Case-folded prefix and trigram index over the catalog's item names.
+
+    Follows catalog.version and applies only the names added or removed since the last sync.
+    """
+
+    def __init__(self, catalog, candidates=20):
+        self.catalog = catalog
+        self.candidates = candidates
+        self.version = None
+        self.names = {}  # folded -> catalog name
+        self.keys = []  # sorted folded names and their words, for prefix lookups
+        self.grams = defaultdict(set)
+
+    def sync(self):
+        if self.version == self.catalog.version:
+            return
+        current = {fold(name): name for name in self.catalog.ids}
+        for key in self.names.keys() - current.keys():
+            self._remove(key)
+        for key in current.keys() - self.names.keys():
+            self._add(key)
+        self.names = current
+        self.version = self.catalog.version
+
+    def _add(self, key):
+        for entry in self._entries(key):
+            bisect.insort(self.keys, entry)
+        for gram in trigrams(key):
+            self.grams[gram].add(key)
+
+    def _remove(self, key):
+        for entry in self._entries(key):
+            i = bisect.bisect_left(self.keys, entry)
+            if i < len(self.keys) and self.keys[i] == entry:
+                del self.keys[i]
+        for gram in trigrams(key):
+            self.grams[gram].discard(key)
+            if not self.grams[gram]:
+                del self.grams[gram]
+
+    def _entries(self, key):
+        # (prefix text, folded name) for the full name and for each later word in it
+        words = key.split(" ")
+        return {(" ".join(words[i:]), key) for i in range(len(words))}
+
+    def lookup(self, query):
+        # The catalog name matching query exactly, ignoring case and spacing
+        self.sync()
+        return self.names.get(fold(query))
+
+    def search(self, query, limit=10):
+        # Best matches first: exact, name prefix, word prefix, then trigram overlap ranked by edit distance
+        self.sync()
+        q = fold(query)
+        if not q:
+            return []
+        ranked = {}
+        i = bisect.bisect_left(self.keys, (q, ""))
+        while i < len(self.keys) and self.keys[i][0].startswith(q) and len(ranked) < limit * 4:
+            entry, key = self.keys[i]
+            rank = (0 if key == q else 1 if entry == key else 2, len(key))
+            if rank < ranked.get(key, (9,)):
+                ranked[key] = rank
+            i += 1
+        if len(ranked) < limit:
+            grams = trigrams(q)
+            overlap = defaultdict(int)
+            for gram in grams:
+                for key in self.grams.get(gram, ()):
+                    overlap[key] += 1
+            min_overlap = max(1, len(grams) // 3)
+            best = sorted((key for key, count in overlap.items() if count >= min_overlap and key not in ranked),
+                          key=overlap.get, reverse=True)[:self.candidates]
+            limit_distance = max(1, len(q) // 3)
+            for key in best:
+                if q in key:
+                    ranked[key] = (3, len(key))
+                    continue
+                # Longer names are compared by their leading part so partially typed names still match
+                target = key[:len(q)] if len(key) > len(q) + limit_distance else key
+                distance = edit_distance(q, target, limit_distance)
+                if distance <= limit_distance:
+                    ranked[key] = (4, distance, -overlap[key])
+        return [self.names[key] for key in sorted(ranked, key=ranked.get)[:limit]]
@@ -0,0 +1,360 @@
+"""Sharded fan-out: a coordinator process publishes stock changes to N worker processes.
+
+Each worker loads the users hashed to its shard (see gag_index.shard_of) with their watchlists,
+and matches and sends on its own event loop with its own Bot connection pool, so broadcasts stay
+off the coordinator's loop that serves the bot handlers. It does not raise throughput: sends are
+capped by the per-token DISPATCH_RATE, and on one core the extra processes make fan-out slower
+(see the README). Workers talk to the
+coordinator over multiprocessing queues and pipes only; the coordinator remains the single DB writer.
+
+A worker that exits, fails a broadcast or does not answer in time has its part of the broadcast
+reported in `failed_shards` so the coordinator can cover those users itself, and is restarted,
+reloading its shard from the database, before the next broadcast.
+"""
+import asyncio
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import sqlite3
+import time
+
+from gag_index import SubscriptionIndex, shard_of
+
+FORWARDED = ("add_user", "set_notified", "set_blocked", "subscribe", "unsubscribe")
+
+
+def worker_main(shard, shards, inbox, replies, db_path, bot_options, dispatch_options):
+    asyncio.run(_worker(shard, shards, inbox, replies, db_path, bot_options, dispatch_options))
+
+
+async def _worker(shard, shards, inbox, replies, db_path, bot_options, dispatch_options):
+    # replies: this worker's own pipe to the coordinator. A queue shared by all workers has a lock
+    # that a worker killed mid-write would hold forever, silencing the others too
+    # Imported here so the coordinator does not pay for them when sharding is off
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    from gag_dispatch import Dispatcher
+    from gag_keyboards import MAIN_KEYBOARDS
+    from gag_stock import build_message
+
+    index = SubscriptionIndex()
+
+    def on_blocked(user_id):
+        index.set_blocked(user_id, True)
+        replies.send(("blocked", shard, user_id))
+
+    dispatcher = Dispatcher(None, on_blocked=on_blocked, **dispatch_options)
+    bot = Bot(**bot_options, request=HTTPXRequest(connection_pool_size=dispatcher.workers))
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            index.load(conn, shard=(shard, shards))
+        finally:
+            conn.close()
+        await bot.initialize()
+    except Exception as e:
+        replies.send(("failed", shard, None, repr(e)))
+        return
+    dispatcher.bot = bot
+    dispatcher.start()
+    replies.send(("ready", shard, index.user_count()))
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            message = await loop.run_in_executor(None, inbox.get)
+            kind = message[0]
+            if kind == "stop":
+                break
+            if kind == "notify":
+                _, seq, check_at, changes, changed, limit = message
+                started = time.perf_counter()
+                try:
+                    matches = index.match(changed)
+                    reply_markup = MAIN_KEYBOARDS[True]
+                    messages = [(user_id, {"text": build_message(check_at, item_names, changes),
+                                           "parse_mode": 'Markdown', "reply_markup": reply_markup})
+                                for user_id, item_names in matches.items()]
+                    if limit is not None:
+                        messages = messages[:limit]
+                    stats = await dispatcher.broadcast(messages)
+                except Exception as e:
+                    replies.send(("failed", shard, seq, repr(e)))
+                    continue
+                stats["matched"] = len(matches)
+                stats["elapsed"] = time.perf_counter() - started
+                replies.send(("done", shard, seq, stats))
+            elif kind in FORWARDED:
+                getattr(index, kind)(*message[1:])
+    finally:
+        await dispatcher.stop()
+        await bot.shutdown()
+
+
+class ShardPool:
+    """Coordinator side: starts the workers, routes user changes and collects broadcast stats.
+
+    The dispatch rate (DISPATCH_RATE unless given) is the total across shards and is split evenly,
+    since Telegram's limit applies per bot token. start() and broadcast() wait at most
+    `start_timeout` and `broadcast_timeout` seconds for the workers. A restarted worker loads its
+    users from the database, so `before_restart` is awaited first to write state the coordinator
+    still holds in memory (e.g. UserCache flags); if it fails, the restart waits for the next broadcast.
+    """
+
+    def __init__(self, shards, db_path, bot_options, rate=None, workers=None, chat_interval=None, on_blocked=None,
+                 before_restart=None, start_timeout=None, broadcast_timeout=None):
+        self.shards = shards
+        self.db_path = db_path
+        self.bot_options = bot_options
+        rate = rate if rate is not None else float(os.getenv("DISPATCH_RATE", "25"))
+        self.dispatch_options = {"rate": rate / shards, "workers": workers, "chat_interval": chat_interval}
+        self.on_blocked = on_blocked
+        self.before_restart = before_restart
+        self.start_timeout = start_timeout if start_timeout is not None else float(os.getenv("SHARD_START_TIMEOUT", "120"))
+        self.broadcast_timeout = broadcast_timeout if broadcast_timeout is not None else float(os.getenv("SHARD_BROADCAST_TIMEOUT", "600"))
+        self.context = multiprocessing.get_context("spawn")
+        self.inboxes = []
+        self.replies = []  # shard -> read end of its reply pipe, None once the worker has gone
+        self.retired = []  # Read ends of replaced workers, closed by the reader between polls
+        self.processes = []
+        self.reader = None
+        self.ready = {}
+        self.ready_future = None
+        self.dead = set()  # Shards that exited or failed to start, until they are restarted
+        self.closing = False
+        self.pending = {}  # seq -> (future, {shard: stats, or None when it failed})
+        self.seq = 0
+        self.restarts = 0
+
+    async def start(self):
+        self.inboxes = [None] * self.shards
+        self.replies = [None] * self.shards
+        self.processes = [None] * self.shards
+        self.ready_future = asyncio.get_running_loop().create_future()
+        for shard in range(self.shards):
+            self._spawn(shard)
+        self.reader = asyncio.create_task(self._read())
+        try:
+            await asyncio.wait_for(self.ready_future, self.start_timeout)
+        except BaseException:
+            await self.stop()
+            raise
+        print(f"🧩 {self.shards} notifier shards ready ({sum(self.ready.values())} users)")
+        return self
+
+    def _spawn(self, shard):
+        # A fresh inbox too; what the previous process left queued is reloaded from the DB, see _restart_dead
+        inbox = self.context.Queue()
+        replies, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=worker_main, name=f"gag-shard-{shard}", daemon=True,
+            args=(shard, self.shards, inbox, writer, self.db_path, self.bot_options, self.dispatch_options),
+        )
+        process.start()
+        writer.close()  # Only the worker writes, so its exit reads as EOF here
+        if self.replies[shard] is not None:
+            self.retired.append(self.replies[shard])
+        self.inboxes[shard], self.replies[shard], self.processes[shard] = inbox, replies, process
+
+    async def _restart_dead(self):
+        dead = [shard for shard, process in enumerate(self.processes) if not process.is_alive()]
+        if not dead:
+            return
+        if self.before_restart is not None:
+            try:
+                await self.before_restart()
+            except Exception as e:
+                print(f"❌ Not restarting notifier shards {dead} yet: {e}")
+                return
+        # No await from here on, so no index change can slip between the write above and the new inboxes
+        for shard in dead:
+            process = self.processes[shard]
+            process.join(0)
+            print(f"🔁 Restarting notifier shard {shard} (exit code {process.exitcode})")
+            self.ready.pop(shard, None)
+            self.dead.discard(shard)
+            self.restarts += 1
+            self._spawn(shard)
+
+    async def stop(self):
+        self.closing = True
+        for inbox in self.inboxes:
+            inbox.put(("stop",))
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.terminate()
+                await loop.run_in_executor(None, process.join, 5)
+            if process.is_alive():
+                process.kill()
+        self.processes = []
+        if self.reader is not None:
+            await self.reader
+            self.reader = None
+        for replies in self.replies + self.retired:
+            if replies is not None:
+                replies.close()
+        self.replies, self.retired = [], []
+
+    def send(self, kind, user_id, *args):
+        # Applies an index change on the shard that owns user_id
+        self.inboxes[shard_of(user_id, self.shards)].put((kind, int(user_id), *args))
+
+    async def broadcast(self, check_at, changes, changed, limit=None):
+        # Same stats shape as Dispatcher.broadcast, summed over the shards that finished; limit caps messages per run.
+        # `failed_shards` lists the shards that exited, failed or timed out; their users got no (or only some) messages
+        await self._restart_dead()
+        self.seq += 1
+        seq = self.seq
+        future = asyncio.get_running_loop().create_future()
+        # Shards that failed to start but have not exited yet cannot take part
+        self.pending[seq] = (future, dict.fromkeys(self.dead))
+        per_shard = math.ceil(limit / self.shards) if limit is not None else None
+        started = time.perf_counter()
+        for shard, inbox in enumerate(self.inboxes):
+            if shard not in self.dead:
+                inbox.put(("notify", seq, check_at, changes, changed, per_shard))
+        if len(self.dead) == self.shards:
+            future.set_result(None)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.broadcast_timeout)
+        except asyncio.TimeoutError:
+            # A stuck worker is killed here (it may not even handle SIGTERM) and restarted by the next broadcast
+            results = self.pending[seq][1]
+            for shard, process in enumerate(self.processes):
+                if shard not in results:
+                    print(f"⌛ Notifier shard {shard} did not finish in {self.broadcast_timeout:.0f}s, stopping it")
+                    process.kill()
+                    await asyncio.get_running_loop().run_in_executor(None, process.join, 5)
+                    results[shard] = None
+        results = self.pending.pop(seq)[1]
+        elapsed = time.perf_counter() - started
+        finished = [stats for stats in results.values() if stats is not None]
+        sent = sum(stats["sent"] for stats in finished)
+        return {
+            "sent": sent,
+            "failed": sum(stats["failed"] for stats in finished),
+            "blocked": sum(stats["blocked"] for stats in finished),
+            "matched": sum(stats["matched"] for stats in finished),
+            "queue_depth": sum(stats["queue_depth"] for stats in finished),
+            "elapsed": elapsed,
+            "rate": sent / elapsed if elapsed > 0 else 0.0,
+            "failed_shards": sorted(shard for shard, stats in results.items() if stats is None),
+        }
+
+    def _finish(self, seq, shard, stats):
+        pending = self.pending.get(seq)
+        if pending is None or shard in pending[1]:
+            return
+        future, results = pending
+        results[shard] = stats
+        if len(results) == self.shards and not future.done():
+            future.set_result(None)
+
+    def _fail(self, shard, reason):
+        print(f"❌ Notifier shard {shard} failed: {reason}")
+        self.dead.add(shard)
+        if not self.ready_future.done() and shard not in self.ready:
+            self.ready_future.set_exception(RuntimeError(f"notifier shard {shard} failed to start: {reason}"))
+        for seq in list(self.pending):
+            self._finish(seq, shard, None)
+
+    @staticmethod
+    def _poll(connections):
+        # Runs in a thread; waits up to a second (so dead workers are noticed even when nothing arrives)
+        # and returns [(connection, message or None at EOF)]
+        received = []
+        for connection in multiprocessing.connection.wait(connections, timeout=1):
+            try:
+                received.append((connection, connection.recv()))
+            except (EOFError, OSError):
+                received.append((connection, None))
+        return received
+
+    def _check_alive(self):
+        for shard, process in enumerate(self.processes):
+            if shard not in self.dead and not process.is_alive():
+                self._fail(shard, f"exited with code {process.exitcode}")
+
+    async def _read(self):
+        loop = asyncio.get_running_loop()
+        while not self.closing:
+            connections = [replies for replies in self.replies if replies is not None]
+            received = await loop.run_in_executor(None, self._poll, connections)
+            # Only closed between polls, never while the thread may be waiting on them
+            for replies in self.retired:
+                replies.close()
+            self.retired = []
+            for connection, message in received:
+                if message is None:
+                    if connection in self.replies:
+                        self.replies[self.replies.index(connection)] = None
+                        connection.close()
+                else:
+                    await self._handle(message)
+            if not self.closing:
+                self._check_alive()
+
+    async def _handle(self, message):
+        kind = message[0]
+        if kind == "ready":
+            self.ready[message[1]] = message[2]
+            if len(self.ready) == self.shards and not self.ready_future.done():
+                self.ready_future.set_result(None)
+        elif kind == "done":
+            _, shard, seq, stats = message
+            self._finish(seq, shard, stats)
+        elif kind == "failed":
+            _, shard, seq, reason = message
+            if seq is None:
+                self._fail(shard, reason)
+            else:
+                print(f"❌ Notifier shard {shard} failed a broadcast: {reason}")
+                self._finish(seq, shard, None)
+        elif kind == "blocked" and self.on_blocked is not None:
+            try:
+                result = self.on_blocked(message[2])
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                print(f"❌ Failed to mark {message[2]} as blocked: {e}")
+
+
+class ShardedIndex(SubscriptionIndex):
+    """Coordinator-side index: keeps the user flags the handlers read and forwards every change
+    to the owning shard. Watchlists live only in the workers, so match() is not available here."""
+
+    def __init__(self):
+        super().__init__()
+        self.pool = None
+
+    def load(self, conn, shard=None):
+        self.load_users(conn)
+
+    def _forward(self, kind, user_id, *args):
+        if self.pool is not None:
+            self.pool.send(kind, user_id, *args)
+
+    def add_user(self, user_id, is_notified=True):
+        super().add_user(user_id, is_notified)
+        self._forward("add_user", user_id, is_notified)
+
+    def set_notified(self, user_id, is_notified):
+        super().set_notified(user_id, is_notified)
+        self._forward("set_notified", user_id, is_notified)
+
+    def set_blocked(self, user_id, is_blocked):
+        super().set_blocked(user_id, is_blocked)
+        self._forward("set_blocked", user_id, is_blocked)
+
+    def subscribe(self, user_id, item_id):
+        self._forward("subscribe", user_id, item_id)
+
+    def unsubscribe(self, user_id, item_id):
+        self._forward("unsubscribe", user_id, item_id)
+
+    def match(self, in_stock):
+        raise NotImplementedError("matching runs in the shard workers")
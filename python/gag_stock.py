@@ -0,0 +1,173 @@
+import hashlib
+import json
+import time
+from collections import defaultdict
+
+from gag_diff import format_change
+from gag_metrics import COMBINE_SECONDS, FETCH_RESULTS, FETCH_SECONDS, PARSE_SECONDS, PAYLOAD_BYTES
+
+STOCK_CATEGORIES = ("gearStock", "seedsStock", "cosmeticsStock", "eggStock", "merchantsStock",
+                    "easterStock", "nightStock", "eventStock")
+
+
+def combine_items(items, key_qty="value"):
+    d = defaultdict(int)
+    for item in items:
+        name = item.get("name")
+        qty = item.get(key_qty, 0) or 0
+        d[name] += qty
+    return [{"name": name, "quantity": qty} for name, qty in d.items()]
+
+
+def parse_categories(data):
+    # /api/stock payload -> {category: {name: quantity}}
+    started = time.perf_counter()
+    combine_seconds = 0.0
+    categories = {}
+    for cat in STOCK_CATEGORIES:
+        combine_started = time.perf_counter()
+        items = combine_items(data.get(cat, []))
+        combine_seconds += time.perf_counter() - combine_started
+        categories[cat] = {it["name"]: it["quantity"] for it in items}
+    COMBINE_SECONDS.observe(combine_seconds)
+    PARSE_SECONDS.observe(time.perf_counter() - started)
+    return categories
+
+
+def flatten_stock(categories):
+    current = {}
+    for stock in categories.values():
+        current.update(stock)
+    return current
+
+
+def parse_stock(data):
+    # /api/stock payload -> {name: quantity} across every category
+    return flatten_stock(parse_categories(data))
+
+
+CATEGORY_TITLES = {
+    "seedsStock": "🌱 Seeds", "gearStock": "⚙️ Gear", "eggStock": "🥚 Eggs", "cosmeticsStock": "🎨 Cosmetics",
+    "merchantsStock": "🛒 Merchants", "eventStock": "🎉 Event", "easterStock": "🐣 Easter", "nightStock": "🌙 Night",
+}
+
+
+def resolve_category(text):
+    # 'seeds', 'Seeds', 'seedsStock', 'egg' or 'eggs' -> the payload key, None when nothing matches
+    key = text.strip().casefold().removesuffix('stock').strip()
+    for cat in STOCK_CATEGORIES:
+        base = cat.casefold().removesuffix('stock')
+        if key in (base, base + 's', base.rstrip('s')):
+            return cat
+    return None
+
+
+def category_title(category):
+    return CATEGORY_TITLES.get(category) or category.removesuffix("Stock").replace("_", " ").title()
+
+
+class StockBoard:
+    """The latest snapshot, rendered once per change for /stock and /mystock."""
+
+    def __init__(self):
+        self.categories = {}
+        self.sections = {}
+        self.updated_at = None
+        self.checked_at = None
+
+    def update(self, categories, now):
+        self.categories = {cat: dict(stock) for cat, stock in categories.items() if stock}
+        self.sections = {
+            cat: f"*{category_title(cat)}*\n" + "\n".join(f"{name}: {qty}" for name, qty in sorted(stock.items()))
+            for cat, stock in self.categories.items()
+        }
+        self.updated_at = self.checked_at = now
+
+    def touch(self, now):
+        # The upstream stock was confirmed unchanged
+        self.checked_at = now
+
+    def find_categories(self, query):
+        query = query.strip().casefold()
+        return [cat for cat in self.sections if query in cat.casefold() or query in category_title(cat).casefold()]
+
+    def render(self, categories=None):
+        return "\n\n".join(self.sections[cat] for cat in (categories or self.sections))
+
+    def render_for(self, item_ids, watched):
+        # Only the items in `watched` (item ids, resolved through item_ids: {name: id})
+        sections = []
+        for cat, stock in self.categories.items():
+            lines = [f"{name}: {qty}" for name, qty in sorted(stock.items()) if item_ids.get(name) in watched]
+            if lines:
+                sections.append(f"*{category_title(cat)}*\n" + "\n".join(lines))
+        return "\n\n".join(sections)
+
+
+def build_message(check_at, item_names, changes, header=None):
+    message = (header or f"📦 Stock update at {check_at}:") + "\n"
+    for item_name in item_names:
+        message += format_change(item_name, changes[item_name]) + "\n"
+    return message
+
+
+def stock_fingerprint(data):
+    # Hash of the stock lists only; the payload also carries timers that change on every request
+    content = json.dumps([data.get(cat, []) for cat in STOCK_CATEGORIES], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+class StockFetcher:
+    """Fetches /api/stock with conditional GETs and reports whether the stock actually changed.
+
+    Unchanged responses are recognised, cheapest first, by a 304, an identical body hash or an
+    identical stock fingerprint, so the caller can skip parsing and fan-out.
+    """
+
+    def __init__(self, http, url):
+        self.http = http
+        self.url = url
+        self.stats = {"requests": 0, "not_modified": 0, "unchanged_body": 0, "unchanged_stock": 0, "changed": 0}
+        self.reset()
+
+    def reset(self):
+        # Forget validators so the next fetch is processed in full (e.g. after a failed pipeline run)
+        self.etag = None
+        self.last_modified = None
+        self.body_hash = None
+        self.fingerprint = None
+        self.data = None
+
+    async def fetch(self):
+        # Returns (data, changed)
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        with FETCH_SECONDS.time():
+            status, response_headers, body = await self.http.request("GET", self.url, headers=headers)
+        self.stats["requests"] += 1
+        if status == 304 and self.data is not None:
+            self._count("not_modified")
+            return self.data, False
+        PAYLOAD_BYTES.observe(len(body))
+        self.etag = response_headers.get("ETag")
+        self.last_modified = response_headers.get("Last-Modified")
+        body_hash = hashlib.sha1(body).hexdigest()
+        if body_hash == self.body_hash:
+            self._count("unchanged_body")
+            return self.data, False
+        self.body_hash = body_hash
+        self.data = json.loads(body)
+        fingerprint = stock_fingerprint(self.data)
+        if fingerprint == self.fingerprint:
+            self._count("unchanged_stock")
+            return self.data, False
+        self.fingerprint = fingerprint
+        self._count("changed")
+        return self.data, True
+
+    def _count(self, result):
+        self.stats[result] += 1
+        FETCH_RESULTS.inc(result=result)
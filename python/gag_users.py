@@ -0,0 +1,143 @@
+import zlib
+from array import array
+
+DEFAULT_DELIVERY = 'message'
+
+
+def _name_hash(username):
+    return zlib.crc32((username or '').encode())
+
+
+class UserCache:
+    """In-memory user state (notification and blocked flags, username, watchlist size, delivery settings).
+
+    Handlers read and write it without touching the database; changed users are collected and
+    written back in one upsert by `drain()` + gag_db.upsert_users, so repeated clicks coalesce into
+    a single row write. The flags live in the subscription index, which matching already reads.
+    Watchlist sizes and username checksums are arrays indexed by the index's user ordinals, so
+    load() must follow the index's load(); usernames themselves are only held until they are written.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.watch_counts = array('H')  # ordinal -> watchlist size
+        self.name_hashes = array('I')  # ordinal -> crc32 of the username, to notice changes
+        self.usernames = {}  # Changed usernames not yet written
+        self.delivery = {}  # Only users with non-default settings
+        self.live_messages = {}
+        self.digests = {}
+        self.dirty = set()
+
+    def load(self, conn):
+        size = len(self.index.user_ids)
+        self.watch_counts, self.name_hashes, self.usernames = array('H', bytes(2 * size)), array('I', bytes(4 * size)), {}
+        for user_id, username in conn.execute('SELECT id, username FROM users ORDER BY id'):
+            ordinal = self.index.ordinal(user_id)
+            if ordinal is not None:
+                self.name_hashes[ordinal] = _name_hash(username)
+        for user_id, count in conn.execute('SELECT user_id, COUNT(*) FROM watchlist GROUP BY user_id'):
+            ordinal = self.index.ordinal(user_id)
+            if ordinal is not None:
+                self.watch_counts[ordinal] = min(count, 0xFFFF)
+        self.delivery, self.live_messages, self.digests = {}, {}, {}
+        rows = conn.execute('SELECT id, delivery, live_message_id, digest_minutes FROM users '
+                            'WHERE delivery != ? OR live_message_id IS NOT NULL OR digest_minutes > 0', (DEFAULT_DELIVERY,))
+        for user_id, delivery, live_message_id, digest_minutes in rows:
+            if delivery != DEFAULT_DELIVERY:
+                self.delivery[user_id] = delivery
+            if live_message_id is not None:
+                self.live_messages[user_id] = live_message_id
+            if digest_minutes:
+                self.digests[user_id] = digest_minutes
+
+    def _slot(self, user_id):
+        # The user's ordinal, creating it (and growing the arrays) for users the index has not seen
+        ordinal = self.index.ordinal(user_id, create=True)
+        missing = ordinal + 1 - len(self.watch_counts)
+        if missing > 0:
+            self.watch_counts.frombytes(bytes(2 * missing))
+            self.name_hashes.frombytes(bytes(4 * missing))
+        return ordinal
+
+    def is_notified(self, user_id):
+        return self.index.is_notified(user_id) is not False
+
+    def register(self, user_id, username):
+        # /start: creates the user if needed, refreshes the username and clears the blocked flag
+        user_id = int(user_id)
+        is_new = self.index.is_notified(user_id) is None
+        self.index.add_user(user_id)
+        ordinal = self._slot(user_id)
+        if is_new or self.name_hashes[ordinal] != _name_hash(username) or self.index.is_blocked(user_id):
+            self.name_hashes[ordinal] = _name_hash(username)
+            self.usernames[user_id] = username or ''  # '' clears a stored username, see gag_db.upsert_users
+            self.index.set_blocked(user_id, False)
+            self.dirty.add(user_id)
+
+    def set_notified(self, user_id, status):
+        # Returns False when the flag already had that value
+        user_id = int(user_id)
+        if self.index.is_notified(user_id) == bool(status):
+            return False
+        self.index.set_notified(user_id, status)
+        self.dirty.add(user_id)
+        return True
+
+    def set_blocked(self, user_id, status):
+        user_id = int(user_id)
+        self.index.set_blocked(user_id, status)
+        self.dirty.add(user_id)
+
+    def watch_count(self, user_id):
+        ordinal = self.index.ordinal(int(user_id))
+        return self.watch_counts[ordinal] if ordinal is not None and ordinal < len(self.watch_counts) else 0
+
+    def watch_changed(self, user_id, delta):
+        # Watchlist rows are written by the handlers themselves; only the count is tracked here
+        ordinal = self._slot(int(user_id))
+        self.watch_counts[ordinal] = min(max(self.watch_counts[ordinal] + delta, 0), 0xFFFF)
+
+    def delivery_mode(self, user_id):
+        return self.delivery.get(int(user_id), DEFAULT_DELIVERY)
+
+    def set_delivery(self, user_id, mode):
+        user_id = int(user_id)
+        if mode == DEFAULT_DELIVERY:
+            self.delivery.pop(user_id, None)
+        else:
+            self.delivery[user_id] = mode
+        self.dirty.add(user_id)
+
+    def live_message(self, user_id):
+        return self.live_messages.get(int(user_id))
+
+    def set_live_message(self, user_id, message_id):
+        self.live_messages[int(user_id)] = message_id
+        self.dirty.add(int(user_id))
+
+    def digest_minutes(self, user_id):
+        return self.digests.get(int(user_id), 0)
+
+    def set_digest(self, user_id, minutes):
+        user_id = int(user_id)
+        if minutes:
+            self.digests[user_id] = minutes
+        else:
+            self.digests.pop(user_id, None)
+        self.dirty.add(user_id)
+
+    def drain(self):
+        # Rows for gag_db.upsert_users: (id, username, is_notified, is_blocked, delivery, live_message_id, digest_minutes);
+        # username is None when it has not changed
+        rows = [(user_id, self.usernames.pop(user_id, None), int(self.is_notified(user_id)), int(self.index.is_blocked(user_id)),
+                 self.delivery_mode(user_id), self.live_message(user_id), self.digest_minutes(user_id))
+                for user_id in self.dirty]
+        self.dirty = set()
+        return rows
+
+    def restore(self, rows):
+        # Marks a failed flush's users dirty again; their current state is written next time
+        for row in rows:
+            self.dirty.add(row[0])
+            if row[1] is not None:
+                self.usernames.setdefault(row[0], row[1])
@@ -0,0 +1,199 @@
+"""Webhook serving mode: receives Telegram updates over HTTP instead of long polling.
+
+    python gag_webhook.py bench --url http://127.0.0.1:8443/telegram --secret S --rate 500 --count 5000
+    python gag_webhook.py bench --local --rate 500 --count 5000
+
+`bench` posts recorded Update JSON (`--updates FILE`, a JSON list) at a fixed rate and reports
+handler latency percentiles. `--local` benchmarks against an in-process server with a trivial
+handler and a fake Bot API, which measures the serving overhead alone.
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import os
+import statistics
+import time
+from collections import deque
+from pathlib import Path
+
+from aiohttp import web
+from telegram import Update
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    if not samples:
+        return {f"p{p}": 0.0 for p in points}
+    ordered = sorted(samples)
+    return {f"p{p}": ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+
+class WebhookServer:
+    """aiohttp server feeding updates to a python-telegram-bot Application, plus a health endpoint.
+
+    Updates are processed before the response is sent, at most `max_concurrency` at a time; Telegram
+    retries anything that does not get a 200.
+    """
+
+    def __init__(self, application, path="/telegram", secret_token=None, max_concurrency=None,
+                 host="0.0.0.0", port=8443):
+        if not secret_token:
+            raise ValueError("a webhook secret token is required; anyone could post updates otherwise")
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.max_concurrency = max_concurrency or int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64"))
+        self.host = host
+        self.port = port
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.latencies = deque(maxlen=10_000)
+        self.updates = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/healthz", self.handle_health)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        print(f"🌐 Webhook listening on {self.host}:{self.port}{self.path}")
+        return self
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_update(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret_token):
+            self.rejected += 1
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except ValueError:
+            return web.Response(status=400)
+        async with self.semaphore:
+            self.in_flight += 1
+            started = time.perf_counter()
+            try:
+                await self.application.process_update(update)
+            finally:
+                self.in_flight -= 1
+                self.updates += 1
+                self.latencies.append(time.perf_counter() - started)
+        return web.Response()
+
+    async def handle_health(self, request):
+        latency = {name: round(value * 1000, 3) for name, value in percentiles(self.latencies).items()}
+        return web.json_response({
+            "status": "ok",
+            "updates": self.updates,
+            "rejected": self.rejected,
+            "in_flight": self.in_flight,
+            "handler_latency_ms": latency,
+        })
+
+
+def sample_updates(count=2):
+    # A /start message and a pagination click, in the shape Telegram posts them
+    user = {"id": 42, "is_bot": False, "first_name": "Bench", "username": "bench"}
+    chat = {"id": 42, "type": "private", "first_name": "Bench"}
+    message = {"message_id": 1, "date": int(time.time()), "chat": chat, "from": user}
+    return [
+        {"update_id": 1, "message": {**message, "text": "/start",
+                                     "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}},
+        {"update_id": 2, "callback_query": {"id": "1", "from": user, "chat_instance": "bench",
+                                            "data": "page_1", "message": {**message, "text": "menu"}}},
+    ][:count]
+
+
+async def _post_all(url, secret, updates, rate, count, concurrency):
+    import aiohttp
+
+    latencies = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {SECRET_HEADER: secret} if secret else {}
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        async def post(body):
+            nonlocal failures
+            async with semaphore:
+                started = time.perf_counter()
+                async with session.post(url, data=body, headers={**headers, "Content-Type": "application/json"}) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        failures += 1
+                latencies.append(time.perf_counter() - started)
+
+        bodies = [json.dumps(update).encode() for update in updates]
+        tasks = []
+        started = time.perf_counter()
+        for i in range(count):
+            tasks.append(asyncio.create_task(post(bodies[i % len(bodies)])))
+            delay = started + (i + 1) / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    result = {name: round(value * 1000, 3) for name, value in percentiles(latencies, (50, 90, 99, 100)).items()}
+    result = {"requests": count, "failures": failures, "achieved_rate": round(count / elapsed, 1),
+              "mean_ms": round(statistics.mean(latencies) * 1000, 3) if latencies else 0.0, **result}
+    return result
+
+
+async def _bench(args):
+    updates = json.loads(Path(args.updates).read_text()) if args.updates else sample_updates()
+    if not args.local:
+        return await _post_all(args.url, args.secret, updates, args.rate, args.count, args.concurrency)
+
+    from telegram.ext import ApplicationBuilder, CallbackQueryHandler, CommandHandler
+    from gag_fakes import FakeTelegramServer
+
+    async def reply(update, context):
+        if update.callback_query:
+            await update.callback_query.answer()
+        else:
+            await update.message.reply_text("ok")
+
+    telegram_server = await FakeTelegramServer().start()
+    application = (ApplicationBuilder().token("123456:bench").base_url(telegram_server.base_url)
+                   .connection_pool_size(args.concurrency).build())
+    application.add_handler(CommandHandler("start", reply))
+    application.add_handler(CallbackQueryHandler(reply))
+    await application.initialize()
+    server = await WebhookServer(application, secret_token="bench", host="127.0.0.1", port=0).start()
+    try:
+        url = f"http://127.0.0.1:{server.port}{server.path}"
+        return await _post_all(url, "bench", updates, args.rate, args.count, args.concurrency)
+    finally:
+        await server.stop()
+        await application.shutdown()
+        await telegram_server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    bench = sub.add_parser("bench", help="post recorded updates at a fixed rate and report latency")
+    bench.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    bench.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET"))
+    bench.add_argument("--updates", help="JSON file with a list of Update objects")
+    bench.add_argument("--rate", type=float, default=200, help="requests per second")
+    bench.add_argument("--count", type=int, default=2000)
+    bench.add_argument("--concurrency", type=int, default=100)
+    bench.add_argument("--local", action="store_true", help="benchmark an in-process server with a fake Bot API")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(_bench(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
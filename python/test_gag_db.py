@@ -0,0 +1,141 @@
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+import gag_db
+from gag_db import MIGRATIONS, Database, _migrate_integer_ids
+from gag_history import StockHistory, create_partition, partition_name
+from gag_index import SubscriptionIndex
+
+TAKEN_AT = 1786000000
+
+
+def _build_baseline(path):
+    # A database as the bot left it before ids became integers: the original TEXT-keyed tables with
+    # duplicate watchlist rows, then the later migrations up to the outbox, with history and rules
+    conn = sqlite3.connect(path)
+    MIGRATIONS[0](conn)
+    conn.executemany('INSERT INTO items (id, name) VALUES (?, ?)', [(1, 'Carrot'), (2, 'Tomato')])
+    conn.executemany('INSERT INTO users (id, username, is_notified, is_blocked) VALUES (?, ?, ?, ?)',
+                     [('100', 'alice', 1, 0), ('200', 'bob', 0, 0), ('300', None, None, 1), ('abc', 'bad', 1, 0)])
+    conn.executemany('INSERT INTO watchlist (user_id, item_id) VALUES (?, ?)',
+                     [('100', 1), ('100', 1), ('100', 2), ('200', 1), ('300', 2), ('abc', 1), (None, 2)])
+    for number, migration in enumerate(MIGRATIONS[1:MIGRATIONS.index(_migrate_integer_ids)], start=2):
+        migration(conn)
+        conn.execute(f'PRAGMA user_version = {number}')
+    conn.execute("UPDATE users SET delivery = 'live', live_message_id = 7 WHERE id = '100'")
+    conn.executemany('INSERT INTO history_items (id, name) VALUES (?, ?)', [(10, 'Carrot'), (11, 'Golden Egg')])
+    conn.execute("INSERT INTO history_categories (id, name) VALUES (1, 'seedsStock')")
+    conn.execute('INSERT INTO history_snapshots (taken_at, items) VALUES (?, 2)', (TAKEN_AT,))
+    table = partition_name(TAKEN_AT)
+    create_partition(conn, table)
+    conn.executemany(f'INSERT INTO {table} VALUES (?, ?, 1, ?, 1)', [(10, TAKEN_AT, 5), (11, TAKEN_AT, 2)])
+    conn.executemany('INSERT INTO rules (user_id, category, item_id, min_quantity) VALUES (?, ?, ?, ?)',
+                     [('100', 'seedsStock', None, 3), ('abc', None, 1, 1)])
+    conn.execute("INSERT INTO outbox (id, created_at, chat_id, payload) VALUES (1, ?, '200', '{\"text\": \"hi\"}')", (TAKEN_AT,))
+    conn.commit()
+    conn.close()
+    return table
+
+
+class IntegerIdsMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = str(Path(self.tmp.name) / 'gag_notifier.db')
+        self.partition = _build_baseline(self.path)
+        self.db = Database(self.path).open()
+        self.conn = self.db.conn
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def rows(self, sql):
+        return self.conn.execute(sql).fetchall()
+
+    def test_schema_version(self):
+        self.assertEqual(self.conn.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+        self.assertEqual(self.rows("SELECT name FROM sqlite_master WHERE name = 'history_items'"), [])
+
+    def test_users_and_watchlist(self):
+        self.assertEqual(self.rows('SELECT id, typeof(id), username, is_notified, is_blocked, delivery, live_message_id '
+                                   'FROM users ORDER BY id'),
+                         [(100, 'integer', 'alice', 1, 0, 'live', 7), (200, 'integer', 'bob', 0, 0, 'message', None),
+                          (300, 'integer', None, 1, 1, 'message', None)])
+        self.assertEqual(self.rows('SELECT user_id, typeof(user_id), item_id FROM watchlist ORDER BY user_id, item_id'),
+                         [(100, 'integer', 1), (100, 'integer', 2), (200, 'integer', 1), (300, 'integer', 2)])
+
+    def test_rules_and_outbox(self):
+        self.assertEqual(self.rows('SELECT user_id, typeof(user_id), category, item_id, min_quantity FROM rules'),
+                         [(100, 'integer', 'seedsStock', None, 3)])
+        self.assertEqual(self.rows('SELECT chat_id, typeof(chat_id) FROM outbox'), [(200, 'integer')])
+
+    def test_history_uses_item_ids(self):
+        ids = dict(self.rows('SELECT name, id FROM items'))
+        self.assertEqual(self.rows("SELECT listed FROM items WHERE name = 'Golden Egg'"), [(0,)])
+        self.assertEqual(self.rows("SELECT listed FROM items WHERE name = 'Carrot'"), [(1,)])
+        self.assertEqual(sorted(self.rows(f'SELECT item_id, quantity FROM {self.partition}')),
+                         sorted([(ids['Carrot'], 5), (ids['Golden Egg'], 2)]))
+        history = StockHistory()
+        history.load(self.conn)
+        self.assertEqual(history.latest, {'Carrot': 5, 'Golden Egg': 2})
+
+    def test_subscription_index(self):
+        index = SubscriptionIndex()
+        index.load(self.conn)
+        self.assertEqual(list(index.user_ids), [100, 200, 300])
+        self.assertEqual({item_id: list(ordinals) for item_id, ordinals in index.subscribers.items()}, {1: [0, 1], 2: [0, 2]})
+        self.assertTrue(index.is_notified(100))
+        self.assertFalse(index.is_notified(200))
+        self.assertTrue(index.is_blocked(300))
+        self.assertEqual(dict(index.match({1: 'Carrot', 2: 'Tomato'})), {100: ['Carrot', 'Tomato']})
+
+
+class OrphanWatchersTest(unittest.TestCase):
+    """A new user's row waits for the user cache flush; their watchlist must not depend on it."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = str(Path(self.tmp.name) / 'gag_notifier.db')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_watch_written_before_user_flush(self):
+        db = Database(self.path).open()
+        db.conn.execute("INSERT INTO items (id, name) VALUES (1, 'Carrot')")
+        db.conn.commit()
+        gag_db.add_watch(db.conn, 42, 1)
+        gag_db.add_watch_names(db.conn, 43, ['Carrot'])
+        gag_db.add_rule(db.conn, 44, 'seedsStock', None, 1)
+        db.conn.commit()
+        db.close()  # Crash: the user cache never flushed these users
+
+        db = Database(self.path).open()
+        index = SubscriptionIndex()
+        index.load(db.conn)
+        self.assertEqual(dict(index.match({1: 'Carrot'})), {42: ['Carrot'], 43: ['Carrot']})
+        self.assertTrue(index.is_active(44))
+        db.close()
+
+    def test_migration_recreates_missing_users(self):
+        conn = sqlite3.connect(self.path)
+        for number, migration in enumerate(MIGRATIONS[:-1], start=1):
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+        conn.execute("INSERT INTO items (id, name) VALUES (1, 'Carrot')")
+        conn.execute("INSERT INTO users (id, is_notified) VALUES (42, 0)")
+        conn.executemany('INSERT INTO watchlist (user_id, item_id) VALUES (?, 1)', [(42,), (43,)])
+        conn.commit()
+        conn.close()
+
+        db = Database(self.path).open()
+        self.assertEqual(db.conn.execute('SELECT id, is_notified, is_blocked FROM users ORDER BY id').fetchall(),
+                         [(42, 0, 0), (43, 1, 0)])
+        db.close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
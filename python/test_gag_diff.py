@@ -0,0 +1,44 @@
+import unittest
+
+from gag_diff import CHANGED, RESTOCKED, SOLD_OUT, diff_stock, merge_changes
+
+
+class DiffStockTest(unittest.TestCase):
+    def test_transitions(self):
+        previous = {"Carrot": 0, "Tomato": 3, "Corn": 4, "Bamboo": 2}
+        current = {"Carrot": 5, "Tomato": 1, "Corn": 0, "Bamboo": 2, "Apple": 1}
+        self.assertEqual(diff_stock(previous, current), {
+            "Carrot": (RESTOCKED, 0, 5),
+            "Tomato": (CHANGED, 3, 1),
+            "Corn": (SOLD_OUT, 4, 0),
+            "Apple": (RESTOCKED, 0, 1),
+        })
+
+    def test_missing_item_is_sold_out(self):
+        self.assertEqual(diff_stock({"Carrot": 5, "Tomato": 0}, {}), {"Carrot": (SOLD_OUT, 5, 0)})
+
+    def test_unchanged_and_still_empty(self):
+        self.assertEqual(diff_stock({"Carrot": 5, "Tomato": 0}, {"Carrot": 5, "Tomato": 0, "Corn": 0}), {})
+
+    def test_first_snapshot_restocks_everything_in_stock(self):
+        self.assertEqual(diff_stock({}, {"Carrot": 5, "Corn": 0}), {"Carrot": (RESTOCKED, 0, 5)})
+
+
+class MergeChangesTest(unittest.TestCase):
+    def test_net_change_from_first_quantity(self):
+        earlier = diff_stock({"Carrot": 0, "Tomato": 3}, {"Carrot": 5, "Tomato": 2})
+        later = diff_stock({"Carrot": 5, "Tomato": 2}, {"Carrot": 2, "Tomato": 0, "Corn": 1})
+        self.assertEqual(merge_changes(earlier, later), {
+            "Carrot": (RESTOCKED, 0, 2),
+            "Tomato": (SOLD_OUT, 3, 0),
+            "Corn": (RESTOCKED, 0, 1),
+        })
+
+    def test_item_back_where_it_started_drops_out(self):
+        earlier = diff_stock({"Carrot": 3}, {"Carrot": 0})
+        later = diff_stock({"Carrot": 0}, {"Carrot": 3})
+        self.assertEqual(merge_changes(earlier, later), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import asyncio
+import time
+import unittest
+
+from telegram.error import Forbidden, RetryAfter
+
+from gag_dispatch import Dispatcher, TokenBucket
+
+
+class FakeBot:
+    """Records (monotonic time, chat_id) per send; `errors` maps chat_id to exceptions raised on its next sends."""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        pending = self.errors.get(chat_id)
+        if pending:
+            raise pending.pop(0)
+        self.sent.append((time.monotonic(), chat_id))
+        return len(self.sent)
+
+
+def _broadcast(dispatcher, messages):
+    async def run():
+        try:
+            return await asyncio.wait_for(dispatcher.broadcast(messages), 10)
+        finally:
+            await dispatcher.stop()
+    return asyncio.run(run())
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_paces_after_the_burst(self):
+        async def run():
+            bucket = TokenBucket(rate=50, capacity=5)
+            started = time.monotonic()
+            for _ in range(15):
+                await bucket.acquire()
+            return time.monotonic() - started
+        # 5 tokens are there at once, the other 10 arrive at 50 per second
+        self.assertGreaterEqual(asyncio.run(run()), 10 / 50 * 0.9)
+
+    def test_pause_holds_every_token(self):
+        async def run():
+            bucket = TokenBucket(rate=1000)
+            bucket.pause(0.2)
+            started = time.monotonic()
+            await bucket.acquire()
+            return time.monotonic() - started
+        self.assertGreaterEqual(asyncio.run(run()), 0.18)
+
+
+class DispatcherTest(unittest.TestCase):
+    def test_spaces_messages_to_the_same_chat(self):
+        bot = FakeBot()
+        stats = _broadcast(Dispatcher(bot, workers=4, rate=1000, chat_interval=0.1),
+                           [(1, {"text": "a"}), (1, {"text": "b"}), (1, {"text": "c"}), (2, {"text": "d"})])
+        self.assertEqual(stats["sent"], 4)
+        times = [at for at, chat_id in bot.sent if chat_id == 1]
+        self.assertTrue(all(later - earlier >= 0.09 for earlier, later in zip(times, times[1:])), times)
+
+    def test_retry_after_pauses_and_resends(self):
+        bot = FakeBot({1: [RetryAfter(1)]})
+        dispatcher = Dispatcher(bot, workers=2, rate=1000, chat_interval=0, max_retries=2)
+        started = time.monotonic()
+        stats = _broadcast(dispatcher, [(1, {"text": "a"}), (2, {"text": "b"})])
+        self.assertEqual((stats["sent"], stats["failed"]), (2, 0))
+        # The retried message waits out the pause, and so does everything queued behind it
+        self.assertGreaterEqual(min(at for at, _ in bot.sent if _ == 1) - started, 0.9)
+
+    def test_retry_after_gives_up_after_max_retries(self):
+        bot = FakeBot({1: [RetryAfter(0), RetryAfter(0), RetryAfter(0)]})
+        stats = _broadcast(Dispatcher(bot, workers=1, rate=1000, chat_interval=0, max_retries=2), [(1, {"text": "a"})])
+        self.assertEqual((stats["sent"], stats["failed"]), (0, 1))
+
+    def test_forbidden_marks_the_chat_blocked(self):
+        blocked, done = [], []
+        bot = FakeBot({1: [Forbidden("bot was blocked by the user")]})
+        dispatcher = Dispatcher(bot, workers=2, rate=1000, chat_interval=0, on_blocked=blocked.append, on_done=done.append)
+        stats = _broadcast(dispatcher, [(1, {"text": "a", "ref": 10}), (2, {"text": "b", "ref": 11})])
+        self.assertEqual((stats["sent"], stats["blocked"]), (1, 1))
+        self.assertEqual(blocked, [1])
+        self.assertEqual(sorted(done), [10, 11])
+
+    def test_unexpected_error_does_not_stop_the_workers(self):
+        done = []
+        bot = FakeBot({1: [ValueError("bad kwarg")]})
+        dispatcher = Dispatcher(bot, workers=1, rate=1000, chat_interval=0, on_done=done.append)
+        stats = _broadcast(dispatcher, [(1, {"text": "a", "ref": 1}), (2, {"text": "b", "ref": 2})])
+        self.assertEqual((stats["sent"], stats["failed"]), (1, 1))
+        self.assertEqual(sorted(done), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
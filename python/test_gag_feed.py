@@ -0,0 +1,51 @@
+import asyncio
+import json
+import unittest
+from pathlib import Path
+
+from gag_feed import StockFeed
+from gag_stock import STOCK_CATEGORIES, parse_categories
+
+EXAMPLE_FRAME = Path(__file__).resolve().parent.parent / "go" / "ex_api.json"
+
+
+def _feed_state(frame):
+    feed = StockFeed(None, None, lambda snapshot: asyncio.sleep(0))
+    asyncio.run(feed.handle_frame(frame))
+    return feed.state
+
+
+class CategoryKeysTest(unittest.TestCase):
+    """The feed and /api/stock must yield the same category keys; rules and history are keyed by them."""
+
+    def test_same_stock_from_both_paths(self):
+        payload = {
+            "seedsStock": [{"name": "Carrot", "value": 5}, {"name": "Carrot", "value": 2}],
+            "eggStock": [{"name": "Common Egg", "value": 3}],
+            "eventStock": [{"name": "Corrupt Radar", "value": 2}],
+            "merchantsStock": [{"name": "Common Gnome Crate", "value": 1}],
+        }
+        frame = {"type": "initial_data", "data": {
+            "seeds": [{"name": "Carrot", "quantity": 5, "available": True}, {"name": "Carrot", "quantity": 2, "available": True}],
+            "eggs": [{"name": "Common Egg", "quantity": 3, "available": True}],
+            "events": [{"name": "Corrupt Radar", "quantity": 2, "available": True}],
+            "honey": [{"name": "Common Gnome Crate", "quantity": 1, "available": True}],
+            "weather": {"type": "rain", "active": True},
+        }}
+        self.assertEqual(_feed_state(frame), parse_categories(payload))
+
+    def test_example_frame_categories(self):
+        state = _feed_state(json.loads(EXAMPLE_FRAME.read_text()))
+        self.assertEqual(set(state), set(STOCK_CATEGORIES))
+        self.assertIn("Common Gnome Crate", state["merchantsStock"])
+
+    def test_update_replaces_normalised_category(self):
+        feed = StockFeed(None, None, lambda snapshot: asyncio.sleep(0))
+        asyncio.run(feed.handle_frame({"type": "initial_data", "data": {"gear": [{"name": "Trowel", "quantity": 1}]}}))
+        asyncio.run(feed.handle_frame({"type": "update", "data": {"gear": [{"name": "Watering Can", "quantity": 4}]}}))
+        self.assertEqual(feed.state["gearStock"], {"Watering Can": 4})
+        self.assertNotIn("gear", feed.state)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import gag_db
+import gag_notifier_v2
+from gag_fakes import FakeTelegramServer
+from gag_outbox import Outbox
+
+CATEGORIES = {"seedsStock": {"Carrot": 5}}
+
+
+class Crash(Exception):
+    pass
+
+
+class CrashingDispatcher:
+    # Stands in for the dispatcher so the process "dies" after the outbox write, before anything is sent
+    async def broadcast(self, messages):
+        raise Crash
+
+
+def _populate(path):
+    db = gag_db.Database(path).open()
+    db.conn.execute("INSERT INTO items (id, name) VALUES (1, 'Carrot')")
+    db.conn.execute("INSERT INTO users (id, username) VALUES (42, 'alice')")
+    db.conn.execute('INSERT INTO watchlist (user_id, item_id) VALUES (42, 1)')
+    db.conn.commit()
+    db.close()
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        for migration in gag_db.MIGRATIONS:
+            migration(self.conn)
+        self.now = 1786000000
+        self.outbox = Outbox(clock=lambda: self.now)
+        self.markup = InlineKeyboardMarkup([[InlineKeyboardButton("Unwatch", callback_data="unwatch:1")]])
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_stage_splices_the_shared_markup(self):
+        messages = [(42, {"text": "Carrot", "parse_mode": "Markdown", "reply_markup": self.markup}),
+                    (43, {"text": "Tomato \"x\"", "reply_markup": self.markup}),
+                    (44, {"reply_markup": self.markup}),
+                    (45, {"text": "plain"})]
+        rows = self.outbox.stage(messages)
+        self.assertEqual([(ref, chat_id) for ref, _, chat_id, _ in rows], [(1, 42), (2, 43), (3, 44), (4, 45)])
+        self.assertEqual([kwargs["ref"] for _, kwargs in messages], [1, 2, 3, 4])
+        expected = [{"text": "Carrot", "parse_mode": "Markdown", "reply_markup": self.markup.to_dict()},
+                    {"text": 'Tomato "x"', "reply_markup": self.markup.to_dict()},
+                    {"reply_markup": self.markup.to_dict()},
+                    {"text": "plain"}]
+        self.assertEqual([json.loads(payload) for _, _, _, payload in rows], expected)
+
+    def test_resume_restores_messages(self):
+        self.outbox.write(self.conn, self.outbox.stage([(42, {"text": "Carrot", "reply_markup": self.markup}),
+                                                         (43, {"text": "Tomato"})]))
+        restarted = Outbox(clock=lambda: self.now)
+        restarted.load(self.conn)
+        messages, dropped = restarted.resume(self.conn, max_age=60)
+        self.assertEqual(dropped, 0)
+        self.assertEqual(messages, [(42, {"text": "Carrot", "reply_markup": self.markup, "ref": 1}),
+                                    (43, {"text": "Tomato", "ref": 2})])
+        self.assertIsInstance(messages[0][1]["reply_markup"], InlineKeyboardMarkup)
+        self.assertEqual(restarted.stage([(44, {"text": "Corn"})])[0][0], 3)
+
+    def test_resume_drops_stale_and_finished_rows(self):
+        self.outbox.write(self.conn, self.outbox.stage([(42, {"text": "old"})]))
+        self.now += 120
+        self.outbox.write(self.conn, self.outbox.stage([(43, {"text": "sent"}), (44, {"text": "new"})]))
+        self.outbox.done(2)
+        self.outbox.delete(self.conn, self.outbox.drain())
+        messages, dropped = self.outbox.resume(self.conn, max_age=60)
+        self.assertEqual(dropped, 1)
+        self.assertEqual(messages, [(44, {"text": "new", "ref": 3})])
+
+
+class ResumeAfterCrashTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = gag_db.DB_PATH
+        gag_db.DB_PATH = str(Path(self.tmp.name) / 'gag_notifier.db')
+        _populate(gag_db.DB_PATH)
+        self.env = dict(os.environ)
+
+    def tearDown(self):
+        gag_db.DB_PATH = self.db_path
+        os.environ.clear()
+        os.environ.update(self.env)
+        self.tmp.cleanup()
+
+    def test_restart_sends_each_message_once(self):
+        asyncio.run(self._crash_and_restart())
+
+    async def _crash_and_restart(self):
+        sent = []
+        telegram = await FakeTelegramServer(on_message=lambda method, chat_id, params: sent.append(chat_id)).start()
+        os.environ.update({"TELEGRAM_BOT_TOKEN": "123456:test", "TELEGRAM_BASE_URL": telegram.base_url,
+                           "NOTIFY_SHARDS": "0", "HISTORY_FLUSH_INTERVAL": "3600"})
+        try:
+            # First run: the notification is planned and written to the outbox, then the process dies
+            app = gag_notifier_v2.setup()
+            await app.initialize()
+            await gag_notifier_v2.start_services(app)
+            dispatcher = gag_notifier_v2.dispatcher
+            gag_notifier_v2.dispatcher = CrashingDispatcher()
+            with self.assertRaises(Crash):
+                await gag_notifier_v2.process_snapshot(CATEGORIES, "12:00", app)
+            await dispatcher.stop()
+            await gag_notifier_v2.http.close()
+            await app.shutdown()
+            gag_notifier_v2.db.close()  # No shutdown flush: whatever was not written is lost
+            self.assertEqual(sent, [])
+
+            # Second run: the outbox is resumed and the same snapshot must not be announced again
+            app = gag_notifier_v2.setup()
+            await app.initialize()
+            await gag_notifier_v2.start_services(app)
+            await gag_notifier_v2.process_snapshot(CATEGORIES, "12:00", app)
+            await gag_notifier_v2.dispatcher.queue.join()
+            await app.post_shutdown(app)
+            await app.shutdown()
+        finally:
+            await telegram.stop()
+        self.assertEqual(sent, [42])
+
+
+if __name__ == '__main__':
+    unittest.main()
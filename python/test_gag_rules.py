@@ -0,0 +1,66 @@
+import unittest
+
+from gag_diff import diff_stock
+from gag_rules import RuleMatcher
+
+ITEM_IDS = {"Carrot": 1, "Tomato": 2, "Common Egg": 3}
+
+
+class Index:
+    # The one SubscriptionIndex method RuleMatcher.match needs
+    def __init__(self, inactive=()):
+        self.inactive = set(inactive)
+
+    def is_active(self, user_id):
+        return user_id not in self.inactive
+
+
+def _match(matcher, categories, previous=None, index=None):
+    current = {name: qty for stock in categories.values() for name, qty in stock.items()}
+    changes = diff_stock(previous or {}, current)
+    return {user_id: sorted(names) for user_id, names in
+            matcher.match(categories, changes, ITEM_IDS, index or Index()).items()}
+
+
+class RuleMatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.matcher = RuleMatcher()
+        self.matcher.add(1, 10, None, 1, 1)              # any Carrot
+        self.matcher.add(2, 11, None, 1, 5)              # Carrot >= 5
+        self.matcher.add(3, 12, "seedsStock", None, 3)   # any seed >= 3
+        self.matcher.add(4, 13, "eggStock", 3, 1)        # Common Egg in the egg shop
+        self.matcher.add(5, 14, "gearStock", 1, 1)       # Carrot, but only in the gear shop
+
+    def test_groups_sorted_by_threshold(self):
+        self.matcher.add(6, 15, None, 1, 3)
+        self.matcher.compile()
+        self.assertEqual(self.matcher.groups[(None, 1)], ([1, 3, 5], [10, 15, 11]))
+        self.assertEqual(self.matcher.groups[("seedsStock", None)], ([3], [12]))
+
+    def test_threshold_prefix(self):
+        self.assertEqual(_match(self.matcher, {"seedsStock": {"Carrot": 2}}), {10: ["Carrot"]})
+        self.assertEqual(_match(self.matcher, {"seedsStock": {"Carrot": 5}}),
+                         {10: ["Carrot"], 11: ["Carrot"], 12: ["Carrot"]})
+
+    def test_category_and_item_rules(self):
+        categories = {"seedsStock": {"Carrot": 1, "Tomato": 4}, "eggStock": {"Common Egg": 1}}
+        self.assertEqual(_match(self.matcher, categories),
+                         {10: ["Carrot"], 12: ["Tomato"], 13: ["Common Egg"]})
+
+    def test_only_changed_items_match(self):
+        categories = {"seedsStock": {"Carrot": 6, "Tomato": 4}}
+        self.assertEqual(_match(self.matcher, categories, previous={"Carrot": 6, "Tomato": 0}), {12: ["Tomato"]})
+
+    def test_inactive_users_skipped(self):
+        self.assertEqual(_match(self.matcher, {"seedsStock": {"Carrot": 5}}, index=Index({10, 12})), {11: ["Carrot"]})
+
+    def test_recompiles_after_add_and_remove(self):
+        self.assertEqual(_match(self.matcher, {"seedsStock": {"Carrot": 5}}).keys(), {10, 11, 12})
+        self.matcher.remove(2)
+        self.matcher.add(7, 16, None, 2, 1)
+        self.assertEqual(_match(self.matcher, {"seedsStock": {"Carrot": 5, "Tomato": 1}}),
+                         {10: ["Carrot"], 12: ["Carrot"], 16: ["Tomato"]})
+
+
+if __name__ == "__main__":
+    unittest.main()